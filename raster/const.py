@@ -12,6 +12,12 @@ WEB_MERCATOR_TILESIZE = 256
 
 GLOBAL_MAX_ZOOM_LEVEL = 18
 
+MORTON_BLOCK_SIZE = 16
+
+# Default tile budget and timeout in seconds for the aggregation view
+AGGREGATION_VIEW_MAX_TILES = 10000
+AGGREGATION_VIEW_TIMEOUT = 300
+
 GDAL_TO_NUMPY_PIXEL_TYPES = {
     1: 'UInt8',  # Eight bit unsigned integer
     2: 'UInt16',  # Sixteen bit unsigned integer
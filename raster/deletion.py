@@ -0,0 +1,66 @@
+"""
+Fast removal of raster tiles.
+
+Deleting tiles through the ORM loads all tile rows to collect the related
+value counts before deleting them. The functions in this module delete the
+tiles and their value counts with raw SQL instead, in batches of a limited
+number of tiles. Outside of a transaction, each batch is committed
+separately, which limits the time the rows are locked and the amount of
+WAL written at once. Inside of a transaction, batches have no such
+benefit, and the tiles can be deleted in a single statement instead.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+
+DELETE_TILE_BATCH_SQL = """
+WITH batch AS (
+    SELECT rid FROM raster_rastertile
+    WHERE rasterlayer_id = %(layer)s {condition}
+    LIMIT %(size)s
+), summaries AS (
+    DELETE FROM raster_rastertilevaluecount
+    WHERE tile_id IN (SELECT rid FROM batch)
+)
+DELETE FROM raster_rastertile
+WHERE rasterlayer_id = %(layer)s
+AND rid IN (SELECT rid FROM batch)
+"""
+
+DELETE_BATCH_SIZE = 10000
+
+
+def delete_tiles(rasterlayer_id, version=None, before_version=None, callback=None, batched=True):
+    """
+    Delete the tiles of a raster layer and their value counts in batches.
+    The tiles can be restricted to a single tile version or to the versions
+    before a tile version. The callback is called after each batch with the
+    number of deleted tiles so far. If batched is False, all tiles are
+    deleted in a single batch. Returns the total number of deleted tiles.
+    """
+    # A batch size of null removes the limit of the batch query
+    size = int(getattr(settings, 'RASTER_DELETE_BATCH_SIZE', DELETE_BATCH_SIZE)) if batched else None
+
+    condition = ''
+    if version is not None:
+        condition = 'AND version = %(version)s'
+    elif before_version is not None:
+        condition = 'AND version < %(version)s'
+
+    sql = DELETE_TILE_BATCH_SQL.format(condition=condition)
+    params = {
+        'layer': rasterlayer_id,
+        'version': version if version is not None else before_version,
+        'size': size,
+    }
+
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                count = cursor.rowcount
+        deleted += count
+        if callback and count:
+            callback(deleted)
+        if size is None or count < size:
+            return deleted
@@ -1,9 +1,15 @@
 import numpy
 from pyparsing import CaselessLiteral, Combine, Forward, Literal, Optional, Word, ZeroOrMore, alphas, nums
 
+from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster
 
-from .const import ALGEBRA_PIXEL_TYPE_GDAL, ALGEBRA_PIXEL_TYPE_NUMPY
+from .const import ALGEBRA_PIXEL_TYPE_NUMPY, GDAL_TO_NUMPY_PIXEL_TYPES
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 
 class FormulaParser(object):
@@ -48,11 +54,42 @@ class FormulaParser(object):
         "sign": numpy.sign,
     }
 
-    def __init__(self):
+    # Map operator symbols to numexpr expression templates. Logical operators
+    # compare against zero to match the numpy logical functions on numbers.
+    ne_opn = {
+        "+": "({0} + {1})",
+        "-": "({0} - {1})",
+        "*": "({0} * {1})",
+        "/": "({0} / {1})",
+        "^": "({0} ** {1})",
+        "==": "({0} == {1})",
+        "!=": "({0} != {1})",
+        ">": "({0} > {1})",
+        ">=": "({0} >= {1})",
+        "<": "({0} < {1})",
+        "<=": "({0} <= {1})",
+        "|": "(({0} != 0) | ({1} != 0))",
+        "&": "(({0} != 0) & ({1} != 0))"
+    }
+
+    # Functions from the fn table that are also available in numexpr
+    ne_fn = ["sin", "cos", "tan", "log", "exp", "abs"]
+
+    # Functions from the fn table with float results
+    float_fn = ["sin", "cos", "tan", "log", "exp"]
+
+    def __init__(self, backend=None):
         """
         Setup the Backus Normal Form (BNF) parser logic.
+
+        The backend argument selects the evaluation engine, it can be either
+        'numpy' or 'numexpr'. If not specified, the RASTER_ALGEBRA_BACKEND
+        setting is used, defaulting to numexpr. The numexpr backend is only
+        used if numexpr is installed, otherwise numpy is used as fallback.
         """
-        self.dtype=ALGEBRA_PIXEL_TYPE_NUMPY
+        self.dtype = ALGEBRA_PIXEL_TYPE_NUMPY
+        self.backend = backend or getattr(settings, 'RASTER_ALGEBRA_BACKEND', 'numexpr')
+        self.parsed = {}
         point = Literal(".")
 
         e = CaselessLiteral("E")
@@ -156,7 +193,8 @@ class FormulaParser(object):
 
         # Evaluate unary operators
         if op == 'unary -':
-            return -self.evaluate_stack(stack)
+            # Promote unsigned operands to avoid wrap around on negation
+            return -self.signed(self.promote(self.evaluate_stack(stack)))
         if op == 'unary !':
             return numpy.logical_not(self.evaluate_stack(stack))
 
@@ -164,13 +202,22 @@ class FormulaParser(object):
         if op in ["+", "-", "*", "/", "^", ">", "<", "==", "!=", "<=", ">=", "|", "&", "!"]:
             op2 = self.evaluate_stack(stack)
             op1 = self.evaluate_stack(stack)
+            # Promote integer operands of arithmetic operators to avoid overflow
+            if op in ["+", "-", "*", "/", "^"]:
+                op1 = self.promote(op1)
+                op2 = self.promote(op2)
             return self.opn[op](op1, op2)
         elif op == "PI":
             return numpy.pi
         elif op == "E":
             return numpy.e
         elif op in self.fn:
-            return self.fn[op](self.evaluate_stack(stack))
+            operand = self.evaluate_stack(stack)
+            # Promote integer operands of functions with float results, numpy
+            # would otherwise compute them in the smallest float type
+            if op in self.float_fn:
+                operand = self.promote(operand)
+            return self.fn[op](operand)
         elif op[0].isalpha() and len(op[0]) == 1 and op[0] in self.data:
             return self.data[op[0]]
         elif op[0].isalpha() and len(op[0]) == 1:
@@ -179,6 +226,123 @@ class FormulaParser(object):
             # If numeric, convert to numpy float
             return numpy.array(op, dtype=self.dtype)
 
+    def promote(self, value):
+        """
+        Convert integer arrays to the evaluation dtype if it is a float type.
+        """
+        if isinstance(value, numpy.ndarray) and value.dtype.kind in ('u', 'i') and numpy.dtype(self.dtype).kind == 'f':
+            return value.astype(self.dtype)
+        return value
+
+    def signed(self, value):
+        """
+        Convert unsigned integer arrays to the smallest signed type that can
+        represent all their values.
+        """
+        if isinstance(value, numpy.ndarray) and value.dtype.kind == 'u':
+            return value.astype(numpy.promote_types(value.dtype, 'int8'))
+        return value
+
+    def numexpr_stack(self, stack, local_dict, promote=False):
+        """
+        Translate a stack element into a numexpr expression string. Variables
+        and numeric literals are added to the local dictionary, literals are
+        added as arrays to preserve the dtype that the numpy evaluator would
+        use for them. Integer variables that are operands of arithmetic
+        operators or float functions are promoted like in the numpy evaluator,
+        numexpr would otherwise compute them in an integer type that can
+        silently overflow.
+        """
+        # Get operator element
+        op = stack.pop()
+
+        # Translate unary operators
+        if op == 'unary -':
+            return '(-{0})'.format(self.numexpr_stack(stack, local_dict, True))
+        if op == 'unary !':
+            return '({0} == 0)'.format(self.numexpr_stack(stack, local_dict))
+
+        # Translate binary operators
+        if op in self.ne_opn:
+            arithmetic = op in ["+", "-", "*", "/", "^"]
+            op2 = self.numexpr_stack(stack, local_dict, arithmetic)
+            op1 = self.numexpr_stack(stack, local_dict, arithmetic)
+            return self.ne_opn[op].format(op1, op2)
+        elif op == "PI":
+            return repr(numpy.pi)
+        elif op == "E":
+            return repr(numpy.e)
+        elif op in self.ne_fn:
+            # The absolute value keeps the integer type, so promotion of its
+            # operand is determined by the enclosing operator
+            promote = promote if op == 'abs' else op in self.float_fn
+            return '{0}({1})'.format(op, self.numexpr_stack(stack, local_dict, promote))
+        elif op[0].isalpha() and len(op[0]) == 1 and op[0] in self.data:
+            # Unsigned variables are converted to signed types for negation
+            value = self.data[op[0]]
+            if 'unary -' in self.expr_stack:
+                value = self.signed(value)
+            promoted = self.promote(value) if promote else value
+            name = op[0] if promoted is value else '{0}_promoted'.format(op[0])
+            local_dict[name] = promoted
+            return name
+        elif op[0].isalpha() and len(op[0]) == 1:
+            raise Exception('Found an undeclared variable in formula.')
+        else:
+            name = 'const{0}'.format(len(local_dict))
+            local_dict[name] = numpy.array(op, dtype=self.dtype)
+            return name
+
+    def numexpr_supported(self):
+        """
+        Return True if the current formula can be evaluated with numexpr, which
+        requires numexpr to be installed and all functions in the formula to
+        be available in numexpr.
+        """
+        if numexpr is None:
+            return False
+        return all(op in self.ne_fn for op in self.expr_stack if op in self.fn)
+
+    def evaluate_numexpr(self):
+        """
+        Evaluate the current expression stack with numexpr.
+
+        The numpy evaluator is run on the first pixel of the input data to
+        obtain the result type, which is then enforced on the numexpr result.
+        Masked input arrays are evaluated on their data, the result is masked
+        where any input is masked or where the result is not a finite number,
+        analogous to the domain masking of numpy masked arrays.
+        """
+        local_dict = {}
+        expression = self.numexpr_stack(list(self.expr_stack), local_dict)
+
+        # Evaluate formula on a single pixel to get the result type
+        data = self.data
+        self.data = {key: val.ravel()[:1] if isinstance(val, numpy.ndarray) else val for key, val in data.items()}
+        try:
+            reference = self.evaluate_stack(list(self.expr_stack))
+        finally:
+            self.data = data
+
+        # Evaluate formula on unmasked data
+        result = numexpr.evaluate(
+            expression,
+            local_dict={key: numpy.ma.getdata(val) for key, val in local_dict.items()},
+        )
+        result = result.astype(numpy.result_type(reference), copy=False)
+
+        # Combine masks of masked input arrays and apply to result
+        masks = [numpy.ma.getmask(val) for val in local_dict.values() if numpy.ma.isMaskedArray(val)]
+        if masks:
+            mask = numpy.zeros(result.shape, dtype='bool')
+            for msk in masks:
+                mask |= msk
+            if result.dtype.kind == 'f':
+                mask |= numpy.logical_not(numpy.isfinite(result))
+            result = numpy.ma.array(result, mask=mask)
+
+        return result
+
     def parse_formula(self, formula):
         """
         Parse a string formula into a BNF expression.
@@ -186,12 +350,28 @@ class FormulaParser(object):
         # Clean formula before parsing
         formula = self.clean_formula(formula)
 
+        # Reuse expression stack if this formula has been parsed before
+        if formula in self.parsed:
+            self.expr_stack = self.parsed[formula]
+            return
+
         # Reset expression stack
         self.expr_stack = []
 
         # Use bnf to parse the string
         self.bnf.parseString(formula)
 
+        self.parsed[formula] = self.expr_stack
+
+    def variable_names(self):
+        """
+        Return the names of the variables used in the current formula.
+        """
+        return set(
+            op[0] for op in self.expr_stack
+            if op[0].isalpha() and op not in self.fn and op not in ('PI', 'E') and not op.startswith('unary')
+        )
+
     def clean_formula(self, formula):
         """
         Remove any white space and line breaks from formula.
@@ -210,8 +390,18 @@ class FormulaParser(object):
         if data:
             self.data = data
 
-        # Evaluate stack on data
-        self.result = self.evaluate_stack(self.expr_stack)
+        # Evaluate stack on data, use numexpr if available and possible
+        self.result = None
+        if self.backend == 'numexpr' and self.numexpr_supported():
+            try:
+                self.result = self.evaluate_numexpr()
+            except (KeyError, ValueError, TypeError):
+                # Fall back to numpy evaluator for input types that are not
+                # supported by numexpr
+                pass
+
+        if self.result is None:
+            self.result = self.evaluate_stack(list(self.expr_stack))
 
         return self.result
 
@@ -229,7 +419,7 @@ class RasterAlgebraParser(FormulaParser):
     Compute raster algebra expressions using the FormulaParser class.
     """
 
-    def evaluate_raster_algebra(self, data, formula, check_aligned=False):
+    def evaluate_raster_algebra(self, data, formula, check_aligned=False, dtype=None):
         """
         Evaluate a raster algebra expression on a set of rasters. All input
         rasters need to be strictly aligned (same size, geotransform and srid).
@@ -238,30 +428,31 @@ class RasterAlgebraParser(FormulaParser):
         names. The resulting dictionary will be used as input data for formula
         evaluation. If the check_aligned flag is set, the input rasters are
         compared to make sure they are aligned.
+
+        The dtype argument sets the pixel type of the evaluation and of the
+        resulting raster. By default, arithmetic is evaluated in Float64, and
+        the result is stored in the smallest pixel type that can hold the
+        result values and the nodata value. For instance, logical expressions
+        result in UInt8.
         """
         # Check that all input rasters are aligned
         if check_aligned:
             self.check_aligned(list(data.values()))
 
-        # Construct list of numpy arrays holding raster pixel data
-        data_arrays = {
-            key: numpy.ma.masked_values(rast.bands[0].data().ravel(), rast.bands[0].nodata_value)
-            for key, rast in data.items()
-        }
-
         # Evaluate formula on raster data
-        result = self.evaluate_formula(formula, data_arrays)
+        result, mask = self.evaluate_raster_algebra_array(data, formula, dtype)
 
         # Reference first original raster for constructing result
         orig = list(data.values())[0]
         orig_band = orig.bands[0]
 
-        # Convert to default number type
-        result = result.astype(ALGEBRA_PIXEL_TYPE_NUMPY)
+        # Set nodata value on masked pixels
+        if orig_band.nodata_value is not None:
+            result[mask] = orig_band.nodata_value
 
         # Return GDALRaster holding results
         return GDALRaster({
-            'datatype': ALGEBRA_PIXEL_TYPE_GDAL,
+            'datatype': self.result_pixeltype(result.dtype, orig_band.nodata_value)[0],
             'driver': 'MEM',
             'width': orig.width,
             'height': orig.height,
@@ -276,6 +467,85 @@ class RasterAlgebraParser(FormulaParser):
             }],
         })
 
+    def evaluate_raster_algebra_array(self, data, formula, dtype=None):
+        """
+        Evaluate a raster algebra expression on a set of rasters and return
+        the flat result array with a boolean nodata mask.
+
+        The nodata mask is computed by exact comparison against the nodata
+        values of the rasters used in the formula. Pixels where the result is
+        not a finite number are masked as well.
+        """
+        # Parse formula to get the variables used in the expression
+        self.parse_formula(formula)
+        names = self.variable_names()
+
+        # Construct flat numpy arrays and nodata mask from raster pixel data
+        data_arrays = {}
+        mask = None
+        for key, rast in data.items():
+            band = rast.bands[0]
+            data_arrays[key] = band.data().ravel()
+            if key in names and band.nodata_value is not None:
+                band_mask = self.nodata_mask(data_arrays[key], band.nodata_value)
+                mask = band_mask if mask is None else mask | band_mask
+
+        # Evaluate formula on raster data
+        self.dtype = ALGEBRA_PIXEL_TYPE_NUMPY if dtype is None else dtype
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = self.evaluate(data_arrays)
+
+        # Mask pixels where the evaluation failed
+        if result.dtype.kind == 'f':
+            invalid = numpy.logical_not(numpy.isfinite(result))
+            mask = invalid if mask is None else mask | invalid
+
+        if mask is None:
+            mask = numpy.zeros(result.shape, dtype='bool')
+
+        # Convert to result pixel type
+        orig_band = list(data.values())[0].bands[0]
+        dtype = self.result_pixeltype(result.dtype if dtype is None else dtype, orig_band.nodata_value)[1]
+        if result.dtype != dtype:
+            result = result.astype(dtype)
+
+        return result, mask
+
+    def nodata_mask(self, data, nodata_value):
+        """
+        Return a boolean mask of the pixels that are equal to the nodata value.
+        The comparison is done in the pixel type of the data.
+        """
+        if numpy.isnan(nodata_value):
+            return numpy.isnan(data)
+
+        # No integer pixel can match a nodata value outside of its type range
+        if data.dtype.kind in ('u', 'i'):
+            info = numpy.iinfo(data.dtype)
+            if not float(nodata_value).is_integer() or not info.min <= nodata_value <= info.max:
+                return numpy.zeros(data.shape, dtype='bool')
+
+        return data == numpy.array(nodata_value, dtype=data.dtype)
+
+    def result_pixeltype(self, result_dtype, nodata_value=None):
+        """
+        Return the smallest GDAL pixel type and its numpy dtype that can hold
+        values of the result dtype and the nodata value.
+        """
+        for datatype, name in sorted(GDAL_TO_NUMPY_PIXEL_TYPES.items()):
+            dtype = numpy.dtype(name.lower())
+            if not numpy.can_cast(result_dtype, dtype):
+                continue
+            if nodata_value is not None:
+                info = numpy.finfo(dtype) if dtype.kind == 'f' else numpy.iinfo(dtype)
+                if dtype.kind != 'f' and not float(nodata_value).is_integer():
+                    continue
+                if not float(info.min) <= nodata_value <= float(info.max):
+                    continue
+            return datatype, dtype
+
+        raise Exception('Could not determine pixel type for algebra result.')
+
     def check_aligned(self, rasters):
         """
         Assert that all input rasters are properly aligned.
@@ -0,0 +1,136 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from raster.models import RasterLayer
+from raster.partitions import TILE_TABLE, partitioned
+from raster.views import RasterView
+
+# Synthetic tiles without raster data on a square grid at one zoom level
+INSERT_TILES_SQL = """
+INSERT INTO raster_rastertile (rasterlayer_id, version, tilez, tilex, tiley)
+SELECT %(layer)s, 0, %(zoom)s, x, y
+FROM generate_series(0, %(size)s - 1) AS x, generate_series(0, %(size)s - 1) AS y
+"""
+
+MORTON_SQL = """
+UPDATE raster_rastertile SET morton = (
+    SELECT SUM(
+        (((tilex::bigint >> bit) & 1) << (2 * bit)) | (((tiley::bigint >> bit) & 1) << (2 * bit + 1))
+    )::bigint
+    FROM generate_series(0, 30) AS bit
+)
+WHERE rasterlayer_id = %s
+"""
+
+POSITION_SQL = """
+SELECT rid FROM raster_rastertile
+WHERE rasterlayer_id = %s AND version = 0 AND tilez = %s AND tilex = %s AND tiley = %s
+"""
+
+# Index layout before the composite tile index
+SINGLE_COLUMN_INDEXES = ('rasterlayer_id', 'tilex', 'tiley', 'tilez')
+
+
+class Command(BaseCommand):
+    help = (
+        'Time tile lookups on a synthetic tile table. With --compare, the '
+        'lookups are also timed with single column indexes on the tile table. '
+        'All changes are rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000, help='Side length of the tile grid.')
+        parser.add_argument('--zoom', type=int, default=12, help='Zoom level of the synthetic tiles.')
+        parser.add_argument('--lookups', type=int, default=1000, help='Number of lookups to time.')
+        parser.add_argument('--compare', action='store_true', help='Also time single column indexes.')
+
+    def handle(self, *args, **options):
+        if partitioned():
+            raise CommandError('Benchmarks are not supported on the partitioned tile table.')
+
+        size = options['size']
+        zoom = options['zoom']
+        if size > 2 ** zoom:
+            raise CommandError('The tile grid does not fit into zoom level {0}.'.format(zoom))
+
+        with transaction.atomic():
+            layer = self.create_tiles(size, zoom)
+
+            positions = [
+                (random.randrange(size), random.randrange(size)) for i in range(options['lookups'])
+            ]
+            self.report('Composite index', layer, zoom, positions)
+
+            if options['compare']:
+                self.use_single_column_indexes()
+                self.report('Single column indexes', layer, zoom, positions)
+
+            # Remove the synthetic tiles and index changes
+            transaction.set_rollback(True)
+
+    def create_tiles(self, size, zoom):
+        """
+        Create a raster layer with synthetic tiles on a square grid.
+        """
+        self.stdout.write('Creating {0} synthetic tiles'.format(size * size))
+        layer = RasterLayer.objects.create(name='Tile lookup benchmark')
+        with connection.cursor() as cursor:
+            cursor.execute(INSERT_TILES_SQL, {'layer': layer.id, 'zoom': zoom, 'size': size})
+            cursor.execute(MORTON_SQL, [layer.id])
+            cursor.execute('ANALYZE {0}'.format(TILE_TABLE))
+        return layer
+
+    def use_single_column_indexes(self):
+        """
+        Replace the composite tile index by single column indexes.
+        """
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, TILE_TABLE)
+            for name, constraint in constraints.items():
+                if constraint['unique'] and not constraint['primary_key']:
+                    cursor.execute('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(TILE_TABLE, name))
+            for column in SINGLE_COLUMN_INDEXES:
+                cursor.execute('CREATE INDEX benchmark_{0} ON {1} ({0})'.format(column, TILE_TABLE))
+            cursor.execute('ANALYZE {0}'.format(TILE_TABLE))
+
+    def report(self, label, layer, zoom, positions):
+        """
+        Time the lookups by tile position and through the tile view, including
+        the search for parent tiles from two zoom levels below.
+        """
+        def position_lookup(tilex, tiley):
+            with connection.cursor() as cursor:
+                cursor.execute(POSITION_SQL, [layer.id, zoom, tilex, tiley])
+                cursor.fetchall()
+
+        def view_lookup(tilex, tiley, tilez):
+            view = RasterView()
+            view.kwargs = {'x': tilex, 'y': tiley, 'z': tilez}
+            view.get_tile(layer.id)
+
+        self.stdout.write(label)
+        self.write_timings('  Position lookup', [
+            self.time_call(position_lookup, tilex, tiley) for tilex, tiley in positions
+        ])
+        self.write_timings('  Tile view', [
+            self.time_call(view_lookup, tilex, tiley, zoom) for tilex, tiley in positions
+        ])
+        self.write_timings('  Tile view from parent', [
+            self.time_call(view_lookup, tilex * 4, tiley * 4, zoom + 2) for tilex, tiley in positions
+        ])
+
+    def time_call(self, func, *args):
+        start = time.time()
+        func(*args)
+        return time.time() - start
+
+    def write_timings(self, label, timings):
+        timings = sorted(timings)
+        self.stdout.write('{0}: mean {1:.3f} ms, median {2:.3f} ms, p95 {3:.3f} ms'.format(
+            label,
+            1000 * sum(timings) / len(timings),
+            1000 * timings[len(timings) // 2],
+            1000 * timings[int(len(timings) * 0.95)],
+        ))
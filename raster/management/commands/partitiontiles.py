@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from raster.partitions import partition_tile_table, partitioned
+
+
+class Command(BaseCommand):
+    help = 'Partition the raster tile table by raster layer'
+
+    def handle(self, *args, **options):
+        if not partitioned():
+            raise CommandError('Enable the RASTER_TILE_PARTITIONS setting before partitioning the tile table.')
+
+        with transaction.atomic():
+            if not partition_tile_table():
+                raise CommandError('The raster tile table is already partitioned.')
+
+        self.stdout.write('Successfully partitioned the raster tile table')
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0025_auto_20151113_0259'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RasterTileValueCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('values', django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None)),
+                ('counts', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                ('tile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='valuecount', to='raster.RasterTile')),
+            ],
+        ),
+    ]
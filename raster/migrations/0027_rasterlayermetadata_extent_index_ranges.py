@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0026_rastertilevaluecount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rasterlayermetadata',
+            name='extent',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), blank=True, null=True, size=4),
+        ),
+        migrations.AddField(
+            model_name='rasterlayermetadata',
+            name='index_ranges',
+            field=django.contrib.postgres.fields.ArrayField(base_field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=5), blank=True, null=True, size=None),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0027_rasterlayermetadata_extent_index_ranges'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rastertile',
+            name='rasterlayer',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='raster.RasterLayer'),
+        ),
+        migrations.AlterField(
+            model_name='rastertile',
+            name='tilex',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='rastertile',
+            name='tiley',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='rastertile',
+            name='tilez',
+            field=models.IntegerField(choices=[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (6, 6), (7, 7), (8, 8), (9, 9), (10, 10), (11, 11), (12, 12), (13, 13), (14, 14), (15, 15), (16, 16), (17, 17), (18, 18)], null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rastertile',
+            unique_together=set([('rasterlayer', 'tilez', 'tilex', 'tiley')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from raster.partitions import partition_tile_table, partitioned
+
+
+def partition_tiles(apps, schema_editor):
+    """
+    Partition the tile table by raster layer if enabled in the settings.
+    """
+    if partitioned():
+        partition_tile_table()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0028_rastertile_unique_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_tiles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0029_partition_rastertile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rastertile',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rasterlayermetadata',
+            name='tile_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rastertile',
+            unique_together=set([('rasterlayer', 'version', 'tilez', 'tilex', 'tiley')]),
+        ),
+    ]
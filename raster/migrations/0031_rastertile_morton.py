@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Interleave the bits of the tile indices, the bits do not overlap so the
+# sum is equal to the bitwise or
+MORTON_SQL = """
+UPDATE raster_rastertile SET morton = (
+    SELECT SUM(
+        (((tilex::bigint >> bit) & 1) << (2 * bit)) | (((tiley::bigint >> bit) & 1) << (2 * bit + 1))
+    )::bigint
+    FROM generate_series(0, 30) AS bit
+)
+WHERE tilex IS NOT NULL AND tiley IS NOT NULL
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0030_tile_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rastertile',
+            name='morton',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunSQL(MORTON_SQL, migrations.RunSQL.noop),
+        migrations.AlterUniqueTogether(
+            name='rastertile',
+            unique_together=set([('rasterlayer', 'version', 'tilez', 'morton')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0031_rastertile_morton'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rastertile',
+            name='rasterlayer',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='raster.RasterLayer'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster', '0032_rastertile_rasterlayer_do_nothing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rasterlayermetadata',
+            name='allocated_tile_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -9,10 +9,13 @@ from django.contrib.gis.db import models
 from django.contrib.gis.gdal import Envelope, OGRGeometry, SpatialReference
 from django.contrib.postgres.fields import ArrayField
 from django.db.models import Max, Min
-from django.db.models.signals import m2m_changed, post_save, pre_save
+from django.db.models.signals import m2m_changed, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 
 from .const import WEB_MERCATOR_SRID
+from .deletion import delete_tiles
+from .partitions import create_partition, drop_partition, partitioned
+from .tiler import morton_key
 from .utils import hex_to_rgba
 from .valuecount import ValueCountMixin
 
@@ -154,11 +157,21 @@ class RasterLayer(models.Model, ValueCountMixin):
 
     def extent(self, srid=WEB_MERCATOR_SRID):
         """
-        Returns bbox for layer.
+        Returns bbox for layer. The web mercator bbox is stored in the layer
+        metadata at parse time, bboxes for other srids are cached per srid.
         """
-        if not self._bbox:
-            # Get bbox for raster in original coordinates
+        if self._bbox is None:
+            self._bbox = {}
+
+        if srid not in self._bbox:
             meta = self.metadata
+
+            # Use stored extent if available
+            if srid == WEB_MERCATOR_SRID and meta.extent:
+                self._bbox[srid] = tuple(meta.extent)
+                return self._bbox[srid]
+
+            # Get bbox for raster in original coordinates
             xmin = meta.uperleftx
             ymax = meta.uperlefty
             xmax = xmin + meta.width * meta.scalex
@@ -182,14 +195,21 @@ class RasterLayer(models.Model, ValueCountMixin):
             yvals = [x[1] for x in coords]
 
             # Set bbox
-            self._bbox = (min(xvals), min(yvals), max(xvals), max(yvals))
-        return self._bbox
+            self._bbox[srid] = (min(xvals), min(yvals), max(xvals), max(yvals))
+        return self._bbox[srid]
 
     def index_range(self, zoom):
         """
-        Returns the index range for
+        Returns the index range for the tiles of this layer at the given zoom
+        level. The index ranges are stored in the layer metadata at parse
+        time, the range is computed from the tiles otherwise.
         """
-        return self.rastertile_set.filter(tilez=zoom).aggregate(
+        meta = self.metadata
+        if meta.index_ranges is not None:
+            index_range = meta.index_range(zoom) or (None, ) * 4
+            return dict(zip(('tilex__min', 'tiley__min', 'tilex__max', 'tiley__max'), index_range))
+
+        return self.rastertile_set.filter(version=meta.tile_version, tilez=zoom).aggregate(
             Min('tilex'), Max('tilex'), Min('tiley'), Max('tiley')
         )
 
@@ -211,6 +231,10 @@ def parse_raster_layer_if_log_is_empty(sender, instance, created, **kwargs):
         RasterLayerParseStatus.objects.create(rasterlayer=instance)
         RasterLayerMetadata.objects.create(rasterlayer=instance)
 
+        # Create tile table partition for this layer
+        if partitioned():
+            create_partition(instance.id)
+
     if instance.rasterfile.name and instance.parsestatus.log == '':
         if hasattr(settings, 'RASTER_USE_CELERY') and settings.RASTER_USE_CELERY:
             from raster.tasks import parse_raster_layer_with_celery
@@ -221,6 +245,27 @@ def parse_raster_layer_if_log_is_empty(sender, instance, created, **kwargs):
             parser.parse_raster_layer()
 
 
+@receiver(pre_delete, sender=RasterLayer)
+def remove_tiles_on_delete(sender, instance, **kwargs):
+    """
+    Removes the tiles of a raster layer that is deleted. The tiles are not
+    collected for the cascading delete, they are removed with raw SQL, or by
+    dropping the tile table partition of the layer if the tile table is
+    partitioned.
+
+    The receiver runs in the transaction that deletes the layer, and the
+    tiles have to be removed in that transaction because of the foreign key
+    constraint on the tile table. Batches would not limit the lock time or
+    the WAL written by that transaction, so the tiles are removed in a
+    single statement. If the delete fails, the layer and all its tiles are
+    kept.
+    """
+    if partitioned():
+        drop_partition(instance.id)
+    else:
+        delete_tiles(instance.id, batched=False)
+
+
 class RasterLayerMetadata(models.Model):
     """
     Stores meta data for a raster layer
@@ -238,10 +283,25 @@ class RasterLayerMetadata(models.Model):
     srs_wkt = models.TextField(null=True, blank=True)
     srid = models.PositiveSmallIntegerField(null=True, blank=True)
     max_zoom = models.PositiveSmallIntegerField(null=True, blank=True)
+    extent = ArrayField(models.FloatField(), size=4, null=True, blank=True)
+    index_ranges = ArrayField(ArrayField(models.IntegerField(), size=5), null=True, blank=True)
+    tile_version = models.IntegerField(default=0)
+    allocated_tile_version = models.IntegerField(default=0)
 
     def __str__(self):
         return self.rasterlayer.name
 
+    def index_range(self, zoom):
+        """
+        Returns the stored tile index range (xmin, ymin, xmax, ymax) for the
+        given zoom level, or None if there are no tiles at that zoom level.
+        The index ranges are stored as one list of the zoom level and the
+        index range for each zoom level with tiles.
+        """
+        for index_range in self.index_ranges or []:
+            if index_range[0] == zoom:
+                return tuple(index_range[1:])
+
 
 class RasterLayerParseStatus(models.Model):
     """
@@ -288,6 +348,14 @@ class RasterLayerBandMetadata(models.Model):
     def __str__(self):
         return '{} - Min {} - Max {}'.format(self.rasterlayer.name, self.min, self.max)
 
+    def percentile(self, q):
+        """
+        Returns an approximation of the q-th percentile of the band values,
+        interpolated linearly from the cumulative band histogram.
+        """
+        counts = numpy.cumsum([0] + self.hist_values)
+        return float(numpy.interp(q / 100.0 * counts[-1], counts, self.hist_bins))
+
     def save(self, *args, **kwargs):
         if not self.pk:
             # Construct empty histogram
@@ -314,10 +382,40 @@ class RasterTile(models.Model):
     )
     rid = models.AutoField(primary_key=True)
     rast = models.RasterField(null=True, blank=True, srid=WEB_MERCATOR_SRID)
-    rasterlayer = models.ForeignKey(RasterLayer, null=True, blank=True, db_index=True)
-    tilex = models.IntegerField(db_index=True, null=True)
-    tiley = models.IntegerField(db_index=True, null=True)
-    tilez = models.IntegerField(db_index=True, null=True, choices=ZOOMLEVELS)
+    # Tiles are not collected when a layer is deleted, they are removed with
+    # raw SQL by the remove_tiles_on_delete receiver instead
+    rasterlayer = models.ForeignKey(RasterLayer, null=True, blank=True, db_index=False, on_delete=models.DO_NOTHING)
+    tilex = models.IntegerField(null=True)
+    tiley = models.IntegerField(null=True)
+    tilez = models.IntegerField(null=True, choices=ZOOMLEVELS)
+    version = models.IntegerField(default=0)
+    morton = models.BigIntegerField(null=True)
+
+    class Meta:
+        # Tiles are looked up by layer, version, zoom level and Morton key with
+        # one composite index. Neighbouring tiles and the tiles of aligned
+        # blocks have nearby keys, so region lookups are a few range scans.
+        unique_together = (('rasterlayer', 'version', 'tilez', 'morton'), )
 
     def __str__(self):
         return '{0} {1}'.format(self.rid, self.filename)
+
+    def save(self, *args, **kwargs):
+        # Compute the Morton key from the tile indices
+        if self.tilex is not None and self.tiley is not None:
+            self.morton = morton_key(self.tilex, self.tiley)
+        super(RasterTile, self).save(*args, **kwargs)
+
+
+class RasterTileValueCount(models.Model):
+    """
+    Pixel value counts of the first band of a raster tile, excluding nodata.
+    The counts are stored for tiles of discrete layers at the max zoom level
+    when the tiles are created.
+    """
+    tile = models.OneToOneField(RasterTile, related_name='valuecount')
+    values = ArrayField(models.FloatField())
+    counts = ArrayField(models.BigIntegerField())
+
+    def __str__(self):
+        return '{0} - {1} values'.format(self.tile_id, len(self.values))
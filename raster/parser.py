@@ -10,11 +10,14 @@ import numpy
 
 from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Max, Min
 from django.dispatch import Signal
 from raster import tiler
 from raster.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
-from raster.models import RasterLayerBandMetadata, RasterTile
+from raster.deletion import delete_tiles
+from raster.formulas import RasterAlgebraParser
+from raster.models import RasterLayerBandMetadata, RasterLayerMetadata, RasterTile, RasterTileValueCount
 
 rasterlayers_parser_ended = Signal(providing_args=['instance'])
 
@@ -108,6 +111,7 @@ class RasterLayerParser(object):
         # Make sure nodata value is set from input
         self.hist_values = []
         self.hist_bins = []
+        self.bandmetas = []
         for i, band in enumerate(self.dataset.bands):
             if self.rasterlayer.nodata is not None:
                 band.nodata_value = float(self.rasterlayer.nodata)
@@ -121,6 +125,8 @@ class RasterLayerParser(object):
                 max=band.max
             )
 
+            self.bandmetas.append(bandmeta)
+
             # Prepare numpy hist values and bins
             self.hist_values.append(numpy.array(bandmeta.hist_values))
             self.hist_bins.append(numpy.array(bandmeta.hist_bins))
@@ -140,7 +146,13 @@ class RasterLayerParser(object):
         meta.srs_wkt = self.dataset.srs.wkt
         meta.srid = self.dataset.srs.srid
 
-        meta.save()
+        # Compute the web mercator extent of the raster, clearing the values
+        # from previous parsing. The index ranges are computed after parsing.
+        # The metadata is saved when the new tiles are activated.
+        meta.extent = None
+        meta.index_ranges = None
+        self.rasterlayer._bbox = None
+        meta.extent = self.rasterlayer.extent()
 
     def close_raster_file(self):
         """
@@ -189,57 +201,71 @@ class RasterLayerParser(object):
         self.log('Creating {0} tiles for zoom {1}.'.format(nr_of_tiles, zoom))
 
         counter = 0
-        for tilex in range(indexrange[0], indexrange[2] + 1):
-            for tiley in range(indexrange[1], indexrange[3] + 1):
-                # Log progress
-                counter += 1
-                if counter % 250 == 0:
-                    self.log('{0} tiles created at zoom {1}'.format(counter, zoom))
-
-                # Calculate raster tile origin
-                bounds = tiler.tile_bounds(tilex, tiley, zoom)
-
-                # Construct band data arrays
-                pixeloffset = (
-                    (tilex - indexrange[0]) * self.tilesize,
-                    (tiley - indexrange[1]) * self.tilesize
-                )
+        # Create the tiles in Morton order, so that neighbouring tiles are
+        # written close to each other
+        for tilex, tiley in tiler.morton_order(indexrange):
+            # Log progress
+            counter += 1
+            if counter % 250 == 0:
+                self.log('{0} tiles created at zoom {1}'.format(counter, zoom))
+
+            # Calculate raster tile origin
+            bounds = tiler.tile_bounds(tilex, tiley, zoom)
+
+            # Construct band data arrays
+            pixeloffset = (
+                (tilex - indexrange[0]) * self.tilesize,
+                (tiley - indexrange[1]) * self.tilesize
+            )
 
-                band_data = [
-                    {
-                        'data': band.data(offset=pixeloffset, size=(self.tilesize, self.tilesize)),
-                        'nodata_value': band.nodata_value
-                    } for band in snapped_dataset.bands
-                ]
-
-                # Add tile data to histogram
-                if zoom == self.max_zoom:
-                    self.push_histogram(band_data)
-
-                # Warp source raster into this tile (in memory)
-                dest = GDALRaster({
-                    'width': self.tilesize,
-                    'height': self.tilesize,
-                    'origin': [bounds[0], bounds[3]],
-                    'scale': [tilescale, -tilescale],
-                    'srid': WEB_MERCATOR_SRID,
-                    'datatype': snapped_dataset.bands[0].datatype(),
-                    'bands': band_data,
-                })
-
-                # Store tile
-                RasterTile.objects.create(
-                    rast=dest,
-                    rasterlayer=self.rasterlayer,
-                    tilex=tilex,
-                    tiley=tiley,
-                    tilez=zoom
-                )
+            band_data = [
+                {
+                    'data': band.data(offset=pixeloffset, size=(self.tilesize, self.tilesize)),
+                    'nodata_value': band.nodata_value
+                } for band in snapped_dataset.bands
+            ]
+
+            # Add tile data to histogram
+            if zoom == self.max_zoom:
+                self.push_histogram(band_data)
+
+            # Warp source raster into this tile (in memory)
+            dest = GDALRaster({
+                'width': self.tilesize,
+                'height': self.tilesize,
+                'origin': [bounds[0], bounds[3]],
+                'scale': [tilescale, -tilescale],
+                'srid': WEB_MERCATOR_SRID,
+                'datatype': snapped_dataset.bands[0].datatype(),
+                'bands': band_data,
+            })
+
+            # Store tile
+            tile = RasterTile.objects.create(
+                rast=dest,
+                rasterlayer=self.rasterlayer,
+                tilex=tilex,
+                tiley=tiley,
+                tilez=zoom,
+                version=self.version,
+            )
+
+            # Store value counts for tiles of discrete layers with integer
+            # pixel values, empty tiles are dropped after parsing and are
+            # not counted
+            integer = band_data[0]['data'].dtype.kind in ('u', 'i')
+            if zoom == self.max_zoom and self.rasterlayer.discrete and integer:
+                values, counts = self.tile_value_count(band_data[0])
+                if len(values):
+                    RasterTileValueCount.objects.create(
+                        tile=tile,
+                        values=values.tolist(),
+                        counts=counts.tolist()
+                    )
 
         # Store histogram data
         if zoom == self.max_zoom:
-            bandmetas = RasterLayerBandMetadata.objects.filter(rasterlayer=self.rasterlayer)
-            for bandmeta in bandmetas:
+            for bandmeta in self.bandmetas:
                 bandmeta.hist_values = self.hist_values[bandmeta.band].tolist()
                 bandmeta.save()
 
@@ -259,6 +285,16 @@ class RasterLayerParser(object):
             # Add counts of this tile to band metadata histogram
             self.hist_values[i] += new_hist[0]
 
+    def tile_value_count(self, data):
+        """
+        Compute the counts of unique values in the band data, ignoring nodata.
+        """
+        values = data['data']
+        if data['nodata_value'] is not None:
+            nodata = RasterAlgebraParser().nodata_mask(values, data['nodata_value'])
+            values = values[numpy.logical_not(nodata)]
+        return numpy.unique(values, return_counts=True)
+
     def drop_empty_rasters(self):
         """
         Remove rasters that are only no-data from the current rasterlayer.
@@ -272,18 +308,89 @@ class RasterLayerParser(object):
         sql = (
             "DELETE FROM raster_rastertile "
             "WHERE ST_Count(rast)=0 "
-            "AND rasterlayer_id={0}"
-        ).format(self.rasterlayer.id)
+            "AND rasterlayer_id={0} "
+            "AND version={1}"
+        ).format(self.rasterlayer.id, self.version)
 
         # Run SQL to drop empty tiles
         cursor = connection.cursor()
         cursor.execute(sql)
 
+    def store_index_ranges(self):
+        """
+        Compute the tile index range of each zoom level for the layer metadata.
+        """
+        ranges = self.rasterlayer.rastertile_set.filter(version=self.version).values('tilez').annotate(
+            Min('tilex'), Min('tiley'), Max('tilex'), Max('tiley')
+        ).order_by('tilez')
+
+        meta = self.rasterlayer.metadata
+        meta.index_ranges = [
+            [rng['tilez'], rng['tilex__min'], rng['tiley__min'], rng['tilex__max'], rng['tiley__max']]
+            for rng in ranges
+        ]
+
+    def allocate_version(self):
+        """
+        Allocate a new tile version for the tiles of this parse. The metadata
+        row of the layer is locked while the version is allocated, so that
+        concurrent parses of the same layer get distinct versions.
+        """
+        meta = self.rasterlayer.metadata
+        with transaction.atomic():
+            current, allocated = RasterLayerMetadata.objects.select_for_update().filter(pk=meta.pk).values_list(
+                'tile_version', 'allocated_tile_version'
+            )[0]
+            # Include the tile versions to skip versions of tiles that were
+            # created before versions were allocated
+            versions = self.rasterlayer.rastertile_set.aggregate(Max('version'))
+            version = max(current, allocated, versions['version__max'] or 0) + 1
+            RasterLayerMetadata.objects.filter(pk=meta.pk).update(allocated_tile_version=version)
+        meta.allocated_tile_version = version
+        return version
+
+    def activate_tiles(self):
+        """
+        Switch the layer to the new tiles by saving the metadata with the new
+        tile version in a single update. Returns False if the tiles of a newer
+        parse have been activated in the meantime.
+        """
+        meta = self.rasterlayer.metadata
+        with transaction.atomic():
+            current, allocated = RasterLayerMetadata.objects.select_for_update().filter(pk=meta.pk).values_list(
+                'tile_version', 'allocated_tile_version'
+            )[0]
+            if current > self.version:
+                return False
+            # Keep the versions allocated by other parses in the meantime
+            meta.allocated_tile_version = allocated
+            meta.tile_version = self.version
+            meta.save()
+        return True
+
+    def remove_old_tiles(self):
+        """
+        Remove tiles of previous versions of the layer, asynchronously if
+        celery is enabled.
+        """
+        if getattr(settings, 'RASTER_USE_CELERY', False):
+            from raster.tasks import remove_old_tiles_with_celery
+            remove_old_tiles_with_celery.delay(self.rasterlayer.id)
+        else:
+            remove_old_tiles(
+                self.rasterlayer.id,
+                callback=lambda count: self.log('Removed {0} old tiles'.format(count)),
+            )
+
     def parse_raster_layer(self):
         """
         This function pushes the raster data from the Raster Layer into the
         RasterTile table.
         """
+        # New tiles are created with a staging version, the current tiles are
+        # served until all new tiles are created
+        self.version = self.allocate_version()
+
         try:
             # Clean previous parse log
             self.log(
@@ -296,9 +403,6 @@ class RasterLayerParser(object):
             self.get_raster_file()
             self.open_raster_file()
 
-            # Remove existing tiles for this layer before loading new ones
-            self.rasterlayer.rastertile_set.all().delete()
-
             # Transform raster to global srid
             if self.dataset.srs.srid == WEB_MERCATOR_SRID:
                 self.log('Dataset already in SRID {0}, skipping transform'.format(WEB_MERCATOR_SRID))
@@ -316,7 +420,6 @@ class RasterLayerParser(object):
 
             # Store max zoom level in metadata
             self.rasterlayer.metadata.max_zoom = self.max_zoom
-            self.rasterlayer.metadata.save()
 
             # Reduce max zoom by one if zoomdown flag was disabled
             if not self.zoomdown:
@@ -333,6 +436,12 @@ class RasterLayerParser(object):
                 self.create_tiles(iz)
 
             self.drop_empty_rasters()
+            self.store_index_ranges()
+
+            # Switch to the new tiles, the tiles are removed if a newer parse
+            # has finished first
+            if not self.activate_tiles():
+                raise Exception('Tiles of a newer parse are active, discarding the tiles of this parse.')
 
             # Send signal for end of parsing
             rasterlayers_parser_ended.send(sender=self.rasterlayer.__class__, instance=self.rasterlayer)
@@ -347,7 +456,23 @@ class RasterLayerParser(object):
                 traceback.format_exc(),
                 status=self.rasterlayer.parsestatus.FAILED
             )
+            # Remove the incomplete new tiles, the current tiles are kept
+            delete_tiles(self.rasterlayer.id, version=self.version)
             raise
         finally:
             self.close_raster_file()
             shutil.rmtree(self.tmpdir)
+
+        # Remove the tiles of the previous version
+        self.remove_old_tiles()
+
+
+def remove_old_tiles(rasterlayer_id, callback=None):
+    """
+    Remove the tiles of a raster layer with versions before the current tile
+    version of the layer. Tiles of newer versions that are still being
+    created by another parse are kept. The callback is called with the number
+    of removed tiles after each batch.
+    """
+    version = RasterLayerMetadata.objects.get(rasterlayer_id=rasterlayer_id).tile_version
+    return delete_tiles(rasterlayer_id, before_version=version, callback=callback)
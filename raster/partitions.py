@@ -0,0 +1,146 @@
+"""
+Optional list partitioning of the raster tile table by raster layer.
+
+If the RASTER_TILE_PARTITIONS setting is enabled, the raster_rastertile
+table is partitioned by rasterlayer_id, with one partition for each layer
+and a default partition for tiles without layer. Deleting a layer then
+drops its partition instead of deleting rows from the shared table, and
+removing old tiles after re-parsing a layer only affects its partition.
+Declarative partitioning requires PostgreSQL 11 or later.
+
+In the partitioned layout, the rid column is indexed but is not a primary
+key, since unique constraints on partitioned tables have to include the
+partition key. For the same reason the value count table does not have a
+foreign key constraint on the tile table, stored value counts are removed
+together with the partitions.
+"""
+from django.conf import settings
+from django.db import connection
+
+TILE_TABLE = 'raster_rastertile'
+
+PARTITION_TILE_TABLE_SQL = """
+ALTER TABLE {table} RENAME TO {table}_unpartitioned;
+
+CREATE TABLE {table} (
+    LIKE {table}_unpartitioned INCLUDING DEFAULTS
+) PARTITION BY LIST (rasterlayer_id);
+
+ALTER SEQUENCE {sequence} OWNED BY {table}.rid;
+
+CREATE TABLE {table}_default PARTITION OF {table} DEFAULT;
+
+CREATE INDEX {table}_rid ON {table} (rid);
+
+ALTER TABLE {table} ADD CONSTRAINT {table}_rasterlayer_id_fk
+    FOREIGN KEY (rasterlayer_id) REFERENCES raster_rasterlayer (id) DEFERRABLE INITIALLY DEFERRED;
+"""
+
+COPY_TILES_SQL = """
+INSERT INTO {table} SELECT * FROM {table}_unpartitioned;
+
+DROP TABLE {table}_unpartitioned;
+"""
+
+UNIQUE_CONSTRAINTS_SQL = """
+SELECT conname, pg_get_constraintdef(oid)
+FROM pg_constraint
+WHERE contype = 'u'
+AND conrelid = %s::regclass
+"""
+
+TILE_FOREIGN_KEYS_SQL = """
+SELECT conname
+FROM pg_constraint
+WHERE contype = 'f'
+AND conrelid = 'raster_rastertilevaluecount'::regclass
+AND confrelid = %s::regclass
+"""
+
+DELETE_VALUE_COUNTS_SQL = """
+DELETE FROM raster_rastertilevaluecount AS summary
+USING {partition} AS tile
+WHERE summary.tile_id = tile.rid
+"""
+
+
+def partitioned():
+    """
+    Returns True if the tile table is partitioned by raster layer.
+    """
+    return getattr(settings, 'RASTER_TILE_PARTITIONS', False)
+
+
+def partition_name(layer_id):
+    """
+    Returns the name of the tile table partition for a raster layer.
+    """
+    return '{0}_{1}'.format(TILE_TABLE, int(layer_id))
+
+
+def partition_tile_table():
+    """
+    Convert the tile table into a table partitioned by raster layer. The
+    existing tiles are copied into one partition for each raster layer.
+    Returns False if the tile table is already partitioned.
+    """
+    with connection.cursor() as cursor:
+        # Abort if the tile table is already partitioned
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = %s::regclass', [TILE_TABLE])
+        if cursor.fetchone()[0] == 'p':
+            return False
+
+        # Get the sequence of the tile ids, it is kept for the new table
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'rid')", [TILE_TABLE])
+        sequence = cursor.fetchone()[0]
+
+        # Drop the foreign key constraint of the value counts on the tile ids
+        cursor.execute(TILE_FOREIGN_KEYS_SQL, [TILE_TABLE])
+        for row in cursor.fetchall():
+            cursor.execute('ALTER TABLE raster_rastertilevaluecount DROP CONSTRAINT {0}'.format(row[0]))
+
+        # Get the unique constraints on the tile position, they are moved to the
+        # new table and include the partition key
+        cursor.execute(UNIQUE_CONSTRAINTS_SQL, [TILE_TABLE])
+        constraints = cursor.fetchall()
+
+        cursor.execute(PARTITION_TILE_TABLE_SQL.format(table=TILE_TABLE, sequence=sequence))
+
+        for name, definition in constraints:
+            cursor.execute('ALTER TABLE {0}_unpartitioned DROP CONSTRAINT {1}'.format(TILE_TABLE, name))
+            cursor.execute('ALTER TABLE {0} ADD CONSTRAINT {1} {2}'.format(TILE_TABLE, name, definition))
+
+        # Create partitions for the existing layers and copy the tiles
+        cursor.execute('SELECT id FROM raster_rasterlayer')
+        for row in cursor.fetchall():
+            create_partition(row[0])
+        cursor.execute(COPY_TILES_SQL.format(table=TILE_TABLE))
+
+    return True
+
+
+def create_partition(layer_id):
+    """
+    Create the tile table partition for a raster layer if it does not exist.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES IN ({2})'.format(
+                partition_name(layer_id), TILE_TABLE, int(layer_id)
+            )
+        )
+
+
+def drop_partition(layer_id):
+    """
+    Remove all tiles of a raster layer by detaching and dropping its
+    partition.
+    """
+    name = partition_name(layer_id)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [name])
+        if cursor.fetchone()[0] is None:
+            return
+        cursor.execute(DELETE_VALUE_COUNTS_SQL.format(partition=name))
+        cursor.execute('ALTER TABLE {0} DETACH PARTITION {1}'.format(TILE_TABLE, name))
+        cursor.execute('DROP TABLE {0}'.format(name))
@@ -1,8 +1,6 @@
 from ctypes import POINTER, c_double, c_int, c_void_p
 
-import numpy
-
-from django.contrib.gis.gdal import OGRGeometry
+from django.contrib.gis.gdal import GDALRaster, OGRGeometry
 from django.contrib.gis.gdal.libgdal import std_call
 from django.contrib.gis.gdal.prototypes.generation import voidptr_output
 
@@ -19,26 +17,60 @@ def rasterize(geom, rast, burn_value=1):
     """
     Rasterize a geometry. The result is aligned with the input raster.
     """
-    # Create in memory target raster
-    rasterized = rast.warp({'name': 'rasterized.MEM', 'driver': 'MEM'})
-    rasterized.bands[0].data(numpy.zeros(rast.width * rast.height))
-    # Set zero as nodata
-    rasterized.bands[0].nodata_value = 0
+    return rasterize_zones([geom], rast, [burn_value])
+
+
+def rasterize_zones(geoms, rast, burn_values, datatype=1):
+    """
+    Rasterize a list of geometries into a zone raster, with one burn value for
+    each geometry and the given GDAL datatype. The result is aligned with the
+    input raster. Where geometries overlap, the later geometry is burned.
+    """
+    # Create in memory target raster, the MEM driver initializes the
+    # pixel values with zeros
+    rasterized = GDALRaster({
+        'driver': 'MEM',
+        'width': rast.width,
+        'height': rast.height,
+        'srid': rast.srs.srid,
+        'datatype': datatype,
+        'bands': [{'nodata_value': 0}],
+    })
+    rasterized.geotransform = rast.geotransform
+
+    return burn_geometries(geoms, rasterized, burn_values)
+
 
-    # Make sure geom is an OGR geometry
-    if not isinstance(geom, OGRGeometry):
-        geom = OGRGeometry(geom.ewkt)
-    geom.transform(rast.srs)
+def burn_geometry(geom, rasterized, burn_value=1):
+    """
+    Burn a geometry into the first band of a raster.
+    """
+    return burn_geometries([geom], rasterized, [burn_value])
+
+
+def burn_geometries(geoms, rasterized, burn_values):
+    """
+    Burn a list of geometries into the first band of a raster in one pass,
+    using one burn value for each geometry.
+    """
+    # Make sure geoms are OGR geometries in the projection of the raster
+    ogr_geoms = []
+    for geom in geoms:
+        if not isinstance(geom, OGRGeometry):
+            geom = OGRGeometry(geom.ewkt)
+        if geom.srid is None or geom.srid != rasterized.srs.srid:
+            geom.transform(rasterized.srs)
+        ogr_geoms.append(geom)
 
     # Set rasterization parameters
     nr_of_bands_to_rasterize = 1
     band_indices_to_rasterize = (c_int * 1)(1)
 
-    nr_of_geometries = 1
-    burn_value = (c_double * 1)(burn_value)
-    geometry_list = (c_void_p * 1)(geom.ptr)
+    nr_of_geometries = len(ogr_geoms)
+    burn_values = (c_double * nr_of_geometries)(*burn_values)
+    geometry_list = (c_void_p * nr_of_geometries)(*[geom.ptr for geom in ogr_geoms])
 
-    # Rasterize this geometry
+    # Rasterize the geometries
     rasterize_geometries(
         rasterized.ptr,
         nr_of_bands_to_rasterize,
@@ -46,7 +78,7 @@ def rasterize(geom, rast, burn_value=1):
         nr_of_geometries,
         geometry_list,
         None, None,  # Transform parameters
-        burn_value,
+        burn_values,
         None, None, None  # Progress functions
     )
 
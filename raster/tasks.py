@@ -1,6 +1,6 @@
 from celery import task
 
-from raster.parser import RasterLayerParser
+from raster.parser import RasterLayerParser, remove_old_tiles
 
 
 @task
@@ -8,3 +8,9 @@ def parse_raster_layer_with_celery(rasterlayer):
     """Wrapper to all the raster parser as a celery task"""
     parser = RasterLayerParser(rasterlayer)
     parser.parse_raster_layer()
+
+
+@task
+def remove_old_tiles_with_celery(rasterlayer_id):
+    """Remove the tiles of previous versions of a layer as a celery task"""
+    remove_old_tiles(rasterlayer_id)
@@ -2,7 +2,9 @@
 Everything required to create TMS tiles.
 """
 from django.conf import settings
-from raster.const import GLOBAL_MAX_ZOOM_LEVEL, WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_TILESIZE, WEB_MERCATOR_WORLDSIZE
+from raster.const import (
+    GLOBAL_MAX_ZOOM_LEVEL, MORTON_BLOCK_SIZE, WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_TILESIZE, WEB_MERCATOR_WORLDSIZE
+)
 
 
 def tile_index_range(bbox, z):
@@ -67,3 +69,84 @@ def closest_zoomlevel(scale, next_higher=True):
         zoomlevel += 1
 
     return zoomlevel
+
+
+def morton_key(x, y):
+    """
+    Calculate the Morton (Z-order) key of a tile by interleaving the bits of
+    the x and y tile indices. Written in base 4 and padded to the zoom level,
+    the key is the quadkey of the tile.
+    """
+    key = 0
+    for bit in range(max(x, y).bit_length()):
+        key |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return key
+
+
+def morton_index(key):
+    """
+    Calculate the x and y tile indices from a Morton key.
+    """
+    x = y = bit = 0
+    while key >> (2 * bit):
+        x |= ((key >> (2 * bit)) & 1) << bit
+        y |= ((key >> (2 * bit + 1)) & 1) << bit
+        bit += 1
+    return x, y
+
+
+def morton_parent(key, z, parent_z):
+    """
+    Calculate the Morton key of the parent of a tile at a lower zoom level.
+    """
+    return key >> (2 * (z - parent_z))
+
+
+def morton_ranges(keys):
+    """
+    Group Morton keys into a list of ranges of consecutive keys.
+    """
+    ranges = []
+    for key in sorted(keys):
+        if ranges and ranges[-1][1] == key - 1:
+            ranges[-1][1] = key
+        else:
+            ranges.append([key, key])
+    return ranges
+
+
+def morton_blocks(indexrange, size):
+    """
+    Split a tile index range into square blocks of tiles that are aligned
+    to the tile grid, in Morton order. The side length of the blocks is a
+    power of two, the blocks at the edges are clipped to the index range.
+    The tiles of a block have consecutive Morton keys.
+    """
+    blocks = [
+        (bx, by)
+        for bx in range(indexrange[0] // size, indexrange[2] // size + 1)
+        for by in range(indexrange[1] // size, indexrange[3] // size + 1)
+    ]
+    return [
+        [
+            max(bx * size, indexrange[0]),
+            max(by * size, indexrange[1]),
+            min((bx + 1) * size - 1, indexrange[2]),
+            min((by + 1) * size - 1, indexrange[3]),
+        ]
+        for bx, by in sorted(blocks, key=lambda block: morton_key(*block))
+    ]
+
+
+def morton_order(indexrange, size=MORTON_BLOCK_SIZE):
+    """
+    Generator yielding the tile indices of an index range in Morton order.
+    """
+    for block in morton_blocks(indexrange, size):
+        tiles = [
+            (tilex, tiley)
+            for tilex in range(block[0], block[2] + 1)
+            for tiley in range(block[1], block[3] + 1)
+        ]
+        for tilex, tiley in sorted(tiles, key=lambda tile: morton_key(*tile)):
+            yield tilex, tiley
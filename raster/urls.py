@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.conf.urls import url
 from django.views.decorators.cache import cache_page
-from raster.views import AlgebraView, LegendView, TmsView
+from raster.views import AggregationView, AlgebraView, LegendView, TmsView
 
 if hasattr(settings, 'RASTER_TILE_CACHE_TIMEOUT'):
     cache_timeout = settings.RASTER_TILE_CACHE_TIMEOUT
@@ -30,4 +30,11 @@ urlpatterns = [
         cache_page(cache_timeout)(LegendView.as_view()),
         name='legend'
     ),
+
+    # Streaming aggregation endpoint
+    url(
+        r'^aggregate/$',
+        AggregationView.as_view(),
+        name='aggregate'
+    ),
 ]
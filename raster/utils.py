@@ -5,6 +5,11 @@ from .formulas import FormulaParser
 
 IMG_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG'}
 
+# Opaque gray rgba colors for all 8 bit values, packed as 32 bit integers
+GRAYSCALE_RGBA = numpy.array(
+    [(val, val, val, 255) for val in range(256)], dtype='uint8'
+).view('uint32').ravel()
+
 
 def hex_to_rgba(value, alpha=255):
     """
@@ -16,16 +21,21 @@ def hex_to_rgba(value, alpha=255):
     return rgb + (alpha, )
 
 
-def band_data_to_image(band_data, colormap):
+def band_data_to_image(band_data, colormap, mask=None):
     """
     Creates an python image from pixel values of a GDALRaster.
     The input is a dictionary that maps pixel values to RGBA UInt8 colors.
+    Pixels flagged in the optional boolean mask are left transparent.
     """
     parser = FormulaParser()
 
     # Get data as 1D array
     dat = band_data.ravel()
 
+    # Get pixels that are not masked as 1D array
+    if mask is not None:
+        valid = numpy.logical_not(mask.ravel())
+
     # Create zeros array
     rgba = numpy.zeros((dat.shape[0], 4), dtype='uint8')
 
@@ -37,12 +47,14 @@ def band_data_to_image(band_data, colormap):
             # Try to use the key as number directly
             key = float(key)
             selector = dat == key
-            rgba[selector] = color
         except ValueError:
             # Otherwise use it as numpy expression directly
             dtype = dat.dtype.name
             selector = parser.evaluate_formula(key, {'x': dat}, dtype=dtype)
-            rgba[selector] = color
+        # Exclude masked pixels
+        if mask is not None:
+            selector = numpy.logical_and(selector, valid)
+        rgba[selector] = color
         stats[orig_key] = int(numpy.sum(selector))
 
     # Reshape array to image size
@@ -52,3 +64,38 @@ def band_data_to_image(band_data, colormap):
     img = Image.fromarray(rgba)
 
     return img, stats
+
+
+def band_data_to_grayscale(band_data, vmin, vmax, mask=None):
+    """
+    Creates a grayscale python image from pixel values of a GDALRaster.
+    The values are linearly stretched from the vmin-vmax range to 0-255.
+    Pixels flagged in the optional boolean mask are left transparent.
+    """
+    # Compute stretch factor, a constant range is rendered black
+    vmin, vmax = float(vmin), float(vmax)
+    factor = 255.0 / (vmax - vmin) if vmax > vmin else 0
+
+    # Preallocate rgba pixels, packed as one 32 bit integer per pixel
+    rgba = numpy.empty(band_data.shape, dtype='uint32')
+
+    if band_data.dtype.kind in ('u', 'i') and band_data.dtype.itemsize <= 2:
+        # Compute rgba values for all possible integer values once and
+        # look them up using the unsigned bit pattern of the pixel values
+        udtype = 'uint{0}'.format(8 * band_data.dtype.itemsize)
+        values = numpy.arange(2 ** (8 * band_data.dtype.itemsize), dtype=udtype).view(band_data.dtype)
+        lut = numpy.clip((values.astype('float64') - vmin) * factor, 0, 255).astype('uint8')
+        numpy.take(GRAYSCALE_RGBA[lut], band_data.view(udtype), out=rgba)
+    else:
+        with numpy.errstate(invalid='ignore'):
+            gray = numpy.clip(numpy.subtract(band_data, vmin, dtype='float64') * factor, 0, 255).astype('uint8')
+        numpy.take(GRAYSCALE_RGBA, gray, out=rgba)
+
+    # Make masked pixels transparent
+    if mask is not None:
+        rgba[mask.reshape(band_data.shape)] = 0
+
+    # Create image from array
+    img = Image.fromarray(rgba.view('uint8').reshape(band_data.shape + (4, )))
+
+    return img
@@ -1,23 +1,39 @@
+import hashlib
+import threading
+import time
 from collections import Counter
+from functools import reduce
+from itertools import groupby
+from multiprocessing import TimeoutError as PoolTimeoutError
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter, or_
 
 import numpy
 
+from django.conf import settings
+from django.contrib.gis.gdal import Envelope, GDALRaster, OGRGeometry
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
+from django.core.cache import caches
 from django.db import connection
+from django.db.models import Q
 
-from .const import WEB_MERCATOR_SRID
-from .formulas import FormulaParser, RasterAlgebraParser
-from .rasterize import rasterize
-from .tiler import tile_index_range
+from .const import MORTON_BLOCK_SIZE, WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from .formulas import RasterAlgebraParser
+from .rasterize import burn_geometry, rasterize, rasterize_zones
+from .tiler import morton_blocks, morton_index, morton_key, morton_ranges, tile_bounds, tile_index_range, tile_scale
 
 
 CLIPPED_VALUE_COUNT_SQL = """
-WITH tiles_for_agg AS (
-    SELECT ST_ValueCount(ST_Clip(ST_Transform(rast, {geom_srid}), ST_GeomFromEWKT('{geom_ewkt}'))) AS vcresult
-    FROM raster_rastertile
-    WHERE ST_Intersects(rast, ST_Transform(ST_GeomFromEWKT('{geom_ewkt}'), {rast_srid}))
-    AND rasterlayer_id = {rasterlayer_id}
-    AND tilez = {zoom}
+WITH aggregation_geom AS (
+    SELECT ST_Transform(ST_GeomFromEWKT(%(geom_ewkt)s), %(rast_srid)s) AS geom
+),
+tiles_for_agg AS (
+    SELECT ST_ValueCount(ST_Clip(rast, aggregation_geom.geom)) AS vcresult
+    FROM raster_rastertile, aggregation_geom
+    WHERE ST_Intersects(rast, aggregation_geom.geom)
+    AND rasterlayer_id = %(rasterlayer_id)s
+    AND version = %(version)s
+    AND tilez = %(zoom)s
 )
 SELECT (vcresult).value, SUM((vcresult).count) AS count
 FROM tiles_for_agg
@@ -28,36 +44,913 @@ GLOBAL_VALUE_COUNT_SQL = """
 WITH tiles_for_agg AS (
     SELECT ST_ValueCount(rast) AS vcresult
     FROM raster_rastertile
-    WHERE rasterlayer_id = {rasterlayer_id}
-    AND tilez = {zoom}
+    WHERE rasterlayer_id = %(rasterlayer_id)s
+    AND version = %(version)s
+    AND tilez = %(zoom)s
 )
 SELECT (vcresult).value, SUM((vcresult).count) AS count
 FROM tiles_for_agg
 GROUP BY (vcresult).value
 """
 
-MINSIZE_SQL = """
-SELECT
-    ST_ScaleX(ST_Transform(rast, {srid})) AS scalex,
-    ST_ScaleY(ST_Transform(rast, {srid})) AS scaley
-FROM raster_rastertile
-WHERE rasterlayer_id = {rasterlayer_id}
-AND tilez = {zoom}
-LIMIT 1
+SUMMARY_VALUE_COUNT_SQL = """
+WITH counts_for_agg AS (
+    SELECT unnest(summary."values") AS value, unnest(summary.counts) AS count
+    FROM raster_rastertilevaluecount AS summary
+    JOIN raster_rastertile AS tile ON summary.tile_id = tile.rid
+    WHERE tile.rasterlayer_id = %(rasterlayer_id)s
+    AND tile.version = %(version)s
+    AND tile.tilez = %(zoom)s
+)
+SELECT value, SUM(count) AS count
+FROM counts_for_agg
+GROUP BY value
 """
 
 MAX_ZOOM_SQL = """
 SELECT MAX(tilez)
 FROM raster_rastertile
-WHERE rasterlayer_id={rasterlayer_id}
+WHERE rasterlayer_id = %(rasterlayer_id)s
+AND version = %(version)s
 """
 
+STATISTICS = ('count', 'sum', 'mean', 'min', 'max', 'std')
+
 
 class RasterAggregationException(Exception):
     pass
 
 
-def aggregator(layer_dict, zoom=None, geom=None, formula=None, acres=True, grouping='auto'):
+class Aggregator(object):
+    """
+    Compute aggregate statistics for a layers dictionary, potentially for
+    an algebra expression and clipped by a geometry.
+
+    The tiles are evaluated one block of the tile range at a time. If more
+    than one worker is configured, the tiles of each block are evaluated
+    in parallel by a thread pool, while the next block is fetched from the
+    database. Every tile results in partial counts as numpy arrays, which
+    are reduced into the final value count.
+    """
+
+    def __init__(self, layer_dict, formula, zoom=None, geom=None, acres=True, grouping='auto', dtype=None,
+                 workers=None, timeout=None, bins=10, max_tiles=None, max_error=None, stats=None, budget=None):
+        from .models import Legend, RasterLayer
+
+        self.layer_dict = layer_dict
+        self.formula = formula
+        self.geom = geom
+        self.acres = acres
+        self.dtype = dtype
+        self.bins = bins
+
+        # Get worker pool size and timeout from settings if not provided
+        if workers is None:
+            workers = getattr(settings, 'RASTER_AGGREGATION_WORKERS', 1)
+        self.workers = int(workers)
+        if timeout is None:
+            timeout = getattr(settings, 'RASTER_AGGREGATION_TIMEOUT', None)
+        self.timeout = timeout
+
+        # Get layers and the current tile version of each layer
+        self.layers = RasterLayer.objects.filter(id__in=layer_dict.values()).select_related('metadata')
+        self.versions = {lyr.id: lyr.metadata.tile_version for lyr in self.layers}
+
+        # Get the budget for the number of tiles read by one aggregation from
+        # settings if not provided
+        if budget is None:
+            budget = getattr(settings, 'RASTER_AGGREGATION_MAX_TILES', None)
+        self.budget = budget
+        self.layer_count = len(set(int(layerid) for layerid in layer_dict.values()))
+
+        # Auto determine grouping based on input data
+        if grouping == 'auto':
+            all_discrete = all([lyr.datatype in ['ca', 'ma'] for lyr in self.layers])
+            grouping = 'discrete' if all_discrete else 'continuous'
+        elif grouping in ('discrete', 'continuous'):
+            pass
+        else:
+            # Try converting the grouping input to int
+            try:
+                grouping = int(grouping)
+            except:
+                raise RasterAggregationException(
+                    'Invalid grouping value found for valuecount.'
+                )
+            # Get legend expressions for grouping, numeric keys are compared
+            # with the values directly
+            self.legend_keys = list(Legend.objects.get(id=grouping).colormap.keys())
+            self.legend_values = []
+            for key in self.legend_keys:
+                try:
+                    self.legend_values.append(float(key))
+                except ValueError:
+                    self.legend_values.append(None)
+        self.grouping = grouping
+
+        # Parse the summary statistics before the zoom level is selected, the
+        # number of passes over the tiles depends on the percentiles
+        self.stats = stats
+        self.percentiles = {}
+        if stats is not None:
+            self.parse_statistics(stats)
+
+        # Compute zoom if not provided, use a coarser zoom level if a tile
+        # budget or an error target is specified
+        self.count_scale = 1
+        self.error = None
+        if zoom is None:
+            max_zoom = zoom = min(self.layers.values_list('metadata__max_zoom', flat=True))
+
+            # Every tile position requires reading one tile per layer, for
+            # each pass over the tiles
+            if self.budget is not None:
+                budget_tiles = max(self.budget // (self.layer_count * self.tile_passes()), 1)
+                max_tiles = budget_tiles if max_tiles is None else min(max_tiles, budget_tiles)
+
+            if max_tiles is not None or max_error is not None:
+                zoom = self.select_zoom(max_zoom, max_tiles, max_error)
+
+                # Scale pixel counts to the resolution of the max zoom level
+                self.count_scale = 4 ** (max_zoom - zoom)
+        self.zoom = zoom
+
+        # Tiles to evaluate, all tiles of the tile range are used if not set
+        self.tile_classes = None
+
+        # Number of tiles read from the database, checked against the budget
+        self.tiles_read = 0
+
+        # Setup thread local storage for formula parsers
+        self.local = threading.local()
+
+    def get_tilerange(self, zoom=None):
+        """
+        Compute the tile index range for the aggregation area at the zoom
+        level of this aggregation, or at the given zoom level. Returns None if
+        the aggregation area does not overlap with the layers.
+        """
+        if zoom is None:
+            zoom = self.zoom
+
+        if self.geom:
+            # Transform geom to web mercator
+            if self.geom.srid != WEB_MERCATOR_SRID:
+                self.geom.transform(WEB_MERCATOR_SRID)
+
+            # Clip against max extent for limiting nr of tiles.
+            # This is important for requests on large areas for small rasters.
+            max_extent = MultiPolygon([Polygon.from_bbox(lyr.extent()) for lyr in self.layers]).envelope
+            max_extent = self.geom.intersection(max_extent)
+
+            # Abort if there is no spatial overlay
+            if max_extent.empty:
+                return
+
+            # Compute tile index range for geometry and given zoom level
+            return tile_index_range(max_extent.extent, zoom)
+        else:
+            # Get index range set for the input layers
+            index_ranges = [tile_index_range(lyr.extent(), zoom) for lyr in self.layers]
+
+            # Compute intersection of index ranges
+            return [
+                max([dat[0] for dat in index_ranges]),
+                max([dat[1] for dat in index_ranges]),
+                min([dat[2] for dat in index_ranges]),
+                min([dat[3] for dat in index_ranges])
+            ]
+
+    def select_zoom(self, max_zoom, max_tiles=None, max_error=None):
+        """
+        Select the zoom level for an approximate aggregation. Starting from
+        the max zoom level, the zoom is reduced until the aggregation area is
+        covered by at most max_tiles tiles. It is then reduced further as long
+        as the estimated relative error stays below max_error. The estimated
+        error of the selected zoom level is stored in the error attribute.
+        """
+        # Get the aggregation area, clipped to the layer extents
+        extents = [lyr.extent() for lyr in self.layers]
+        area = MultiPolygon([Polygon.from_bbox(extent) for extent in extents]).envelope
+        if self.geom:
+            if self.geom.srid != WEB_MERCATOR_SRID:
+                self.geom.transform(WEB_MERCATOR_SRID)
+            area = self.geom.intersection(area)
+        else:
+            area = Polygon.from_bbox((
+                max([extent[0] for extent in extents]),
+                max([extent[1] for extent in extents]),
+                min([extent[2] for extent in extents]),
+                min([extent[3] for extent in extents]),
+            ))
+
+        # Keep max zoom if there is no overlap
+        if area.empty or not area.area:
+            return max_zoom
+
+        zoom = max_zoom
+        if max_tiles is not None:
+            while zoom > 0:
+                tilerange = self.get_tilerange(zoom)
+                if (tilerange[2] - tilerange[0] + 1) * (tilerange[3] - tilerange[1] + 1) <= max_tiles:
+                    break
+                zoom -= 1
+
+        if max_error is not None:
+            while zoom > 0 and self.estimate_error(area, zoom - 1) <= max_error:
+                zoom -= 1
+
+        self.error = self.estimate_error(area, zoom)
+
+        return zoom
+
+    def estimate(self):
+        """
+        Estimate the work for this aggregation. Returns a dictionary with the
+        zoom level, the number of tile positions in the tile range, the number
+        of layers, the number of passes over the tiles and the number of
+        tiles to read, the tile budget and the estimated relative error if the
+        zoom level was selected for an approximation.
+        """
+        tilerange = self.get_tilerange()
+        if tilerange is None:
+            positions = 0
+        else:
+            positions = max(tilerange[2] - tilerange[0] + 1, 0) * max(tilerange[3] - tilerange[1] + 1, 0)
+
+        passes = self.tile_passes()
+
+        return {
+            'zoom': self.zoom,
+            'positions': positions,
+            'layers': self.layer_count,
+            'passes': passes,
+            'tiles': positions * self.layer_count * passes,
+            'budget': self.budget,
+            'error': self.error,
+        }
+
+    def stored_value_range(self):
+        """
+        Return the value range from the band metadata of the latest parse for
+        formulas with a single layer name, or None if it is not available.
+        """
+        from .models import RasterLayerBandMetadata
+
+        name = self.formula.strip()
+        if self.dtype is not None or name not in self.layer_dict:
+            return
+
+        meta = RasterLayerBandMetadata.objects.filter(
+            rasterlayer_id=self.layer_dict[name],
+            band=0,
+        ).order_by('-pk').first()
+        if meta:
+            return meta.min, meta.max
+
+    def tile_passes(self):
+        """
+        Return the number of passes over the tiles. Histograms with a number
+        of bins require a first pass to compute the value range, unless the
+        range is known from the band metadata. Summary statistics only use a
+        histogram for percentiles.
+        """
+        if self.stats is not None:
+            if not self.percentiles:
+                return 1
+        elif self.grouping != 'continuous':
+            return 1
+        if not isinstance(self.bins, int) or self.stored_value_range() is not None:
+            return 1
+        return 2
+
+    def admit(self):
+        """
+        Raise an exception if the aggregation exceeds the tile budget at the
+        zoom level of this aggregation, and reset the number of tiles read.
+        """
+        self.tiles_read = 0
+        if self.budget is None:
+            return
+        tiles = self.estimate()['tiles']
+        if tiles > self.budget:
+            raise RasterAggregationException(
+                'Aggregation requires {0} tiles at zoom level {1}, '
+                'exceeding the budget of {2} tiles.'.format(tiles, self.zoom, self.budget)
+            )
+
+    def estimate_error(self, area, zoom):
+        """
+        Estimate the relative error of pixel counts in the aggregation area at
+        a zoom level. The pixels along the boundary of the area are only
+        partially within the area, so the error is estimated as the ratio of
+        the boundary pixel area to the total area.
+        """
+        return area.length * tile_scale(zoom) / area.area
+
+    def tile_count(self, tilerange):
+        """
+        Return the number of tile positions to evaluate in the tile range.
+        """
+        if self.tile_classes is not None:
+            return len(self.tile_classes)
+        return (tilerange[2] - tilerange[0] + 1) * (tilerange[3] - tilerange[1] + 1)
+
+    def tile_blocks(self, tilerange):
+        """
+        Generator yielding the tiles of the tile range block by block, in
+        Morton order. Each block is yielded with the number of tile positions
+        it covers, and a list of tile indices and data dictionaries with named
+        tiles for algebra evaluation. Tiles that are missing in any of the
+        layers are skipped.
+
+        Instead of streaming all tiles from one server side cursor, the tiles
+        are fetched with one query per block of MORTON_BLOCK_SIZE by
+        MORTON_BLOCK_SIZE tile positions. The database driver reads the
+        complete result of a query into memory, so at most the rasters of one
+        block, that is 256 tile positions times the number of layers, are held
+        in memory at once. The queries are short and do not need to keep a
+        transaction open while the tiles are evaluated.
+
+        The tiles read are counted, and reading stops with an exception when
+        more tiles than the budget were read.
+        """
+        from .models import RasterTile
+
+        # Map layer ids to the names they are used with in the formula
+        layer_names = {}
+        for name, layerid in self.layer_dict.items():
+            layer_names.setdefault(int(layerid), []).append(name)
+
+        for block in morton_blocks(tilerange, MORTON_BLOCK_SIZE):
+            # Only fetch the tiles that intersect with the geometry and that are
+            # not counted from stored value counts, with one index range for
+            # each run of consecutive Morton keys
+            keys = [
+                morton_key(tilex, tiley)
+                for tilex in range(block[0], block[2] + 1)
+                for tiley in range(block[1], block[3] + 1)
+                if (self.tile_classes is None or (tilex, tiley) in self.tile_classes)
+                and (tilex, tiley) not in self.summaries
+            ]
+            if not keys:
+                continue
+            query = reduce(or_, [Q(morton__gte=run[0], morton__lte=run[1]) for run in morton_ranges(keys)])
+
+            # Fetch the current tiles of all layers in this block of the tile
+            # range
+            tiles = RasterTile.objects.filter(
+                query,
+                reduce(or_, [Q(rasterlayer_id=layerid, version=self.versions[layerid]) for layerid in layer_names]),
+                tilez=self.zoom,
+            ).order_by('morton').values_list('morton', 'rasterlayer_id', 'rast')
+
+            # Group the tiles by position
+            tiles_in_block = []
+            for key, rows in groupby(tiles.iterator(), key=itemgetter(0)):
+                data = {}
+                for row in rows:
+                    self.tiles_read += 1
+                    for name in layer_names[row[1]]:
+                        data[name] = row[2]
+
+                # Ignore this tile if it is missing in any of the input layers
+                if len(data) == len(self.layer_dict):
+                    tilex, tiley = morton_index(key)
+                    tiles_in_block.append((tilex, tiley, data))
+
+            # Stop if more tiles were read than the estimate admitted
+            if self.budget is not None and self.tiles_read > self.budget:
+                raise RasterAggregationException(
+                    'Aggregation read {0} tiles, exceeding the budget of {1} tiles.'.format(self.tiles_read, self.budget)
+                )
+
+            yield len(keys), tiles_in_block
+
+    def classify_tiles(self, tilerange):
+        """
+        Classify the tiles of the tile range against the clip geometry. Returns
+        a dictionary with the indices of the tiles that intersect with the
+        geometry as keys, and a flag that is True for tiles that are completely
+        within the geometry as values. Tiles outside of the geometry are not
+        included.
+        """
+        prepared = self.geom.prepared
+        tile_classes = {}
+        for tilex in range(tilerange[0], tilerange[2] + 1):
+            for tiley in range(tilerange[1], tilerange[3] + 1):
+                bounds = Polygon.from_bbox(tile_bounds(tilex, tiley, self.zoom))
+                if prepared.contains(bounds):
+                    tile_classes[(tilex, tiley)] = True
+                elif prepared.intersects(bounds):
+                    tile_classes[(tilex, tiley)] = False
+        return tile_classes
+
+    def get_summaries(self, tilerange):
+        """
+        Get the value counts stored at parse time for the tiles of the tile
+        range. Stored counts can only be used for a formula that is a single
+        layer name, and only for tiles that are completely within the clip
+        geometry. Returns a dictionary with tile indices as keys and arrays of
+        values and counts as values.
+        """
+        from .models import RasterTileValueCount
+
+        name = self.formula.strip()
+        if self.dtype is not None or self.grouping == 'continuous' or name not in self.layer_dict:
+            return {}
+
+        summaries = RasterTileValueCount.objects.filter(
+            tile__rasterlayer_id=self.layer_dict[name],
+            tile__version=self.versions[int(self.layer_dict[name])],
+            tile__tilez=self.zoom,
+            tile__tilex__gte=tilerange[0],
+            tile__tilex__lte=tilerange[2],
+            tile__tiley__gte=tilerange[1],
+            tile__tiley__lte=tilerange[3],
+        ).values_list('tile__tilex', 'tile__tiley', 'values', 'counts')
+
+        return {
+            (tilex, tiley): (numpy.array(values), numpy.array(counts))
+            for tilex, tiley, values, counts in summaries.iterator()
+            if not self.geom or self.tile_classes.get((tilex, tiley))
+        }
+
+    @property
+    def parser(self):
+        """
+        Raster algebra parser for the current thread.
+        """
+        if not hasattr(self.local, 'parser'):
+            self.local.parser = RasterAlgebraParser()
+        return self.local.parser
+
+    def rasterize_geom(self, tilerange):
+        """
+        Rasterize the clip geometry on the pixel grid of the tile range and
+        return a boolean mask of the pixels outside of the geometry. Returns
+        None if the grid has more pixels than allowed by the
+        RASTER_AGGREGATION_MAX_MASK_PIXELS setting.
+        """
+        tilesize = int(getattr(settings, 'RASTER_TILESIZE', WEB_MERCATOR_TILESIZE))
+        width = (tilerange[2] - tilerange[0] + 1) * tilesize
+        height = (tilerange[3] - tilerange[1] + 1) * tilesize
+        if width * height > getattr(settings, 'RASTER_AGGREGATION_MAX_MASK_PIXELS', 2 ** 25):
+            return
+
+        bounds = tile_bounds(tilerange[0], tilerange[1], self.zoom)
+        scale = tile_scale(self.zoom)
+        grid = GDALRaster({
+            'driver': 'MEM',
+            'width': width,
+            'height': height,
+            'srid': WEB_MERCATOR_SRID,
+            'origin': [bounds[0], bounds[3]],
+            'scale': [scale, -scale],
+            'datatype': 1,
+            'bands': [{'nodata_value': 0}],
+        })
+        burn_geometry(self.ogr_geom, grid)
+
+        return grid.bands[0].data() != 1
+
+    def evaluate_tile(self, tile):
+        """
+        Evaluate the formula for one tile position and return the values of
+        the pixels that are not masked.
+        """
+        tilex, tiley, data = tile
+
+        # Evaluate algebra on tiles, get flat result array and nodata mask
+        result_data, result_mask = self.parser.evaluate_raster_algebra_array(data, self.formula, dtype=self.dtype)
+
+        # Apply rasterized geometry as mask if clip geometry was provided, tiles
+        # that are completely within the geometry do not need to be masked
+        if self.geom and not self.tile_classes[(tilex, tiley)]:
+            rast = list(data.values())[0]
+            if self.geom_mask is not None:
+                # Slice the tile from the geometry mask of the tile range
+                row = (tiley - self.tilerange[1]) * rast.height
+                col = (tilex - self.tilerange[0]) * rast.width
+                rastgeom_mask = self.geom_mask[row:row + rast.height, col:col + rast.width].ravel()
+            else:
+                # Rasterize the aggregation area to the tile
+                rastgeom = rasterize(self.ogr_geom, rast)
+
+                # Get boolean mask based on rasterized geom
+                rastgeom_mask = rastgeom.bands[0].data().ravel() != 1
+
+            # Apply geometry mask to result mask
+            result_mask |= rastgeom_mask
+
+        # Drop masked pixels from result data
+        return result_data[numpy.logical_not(result_mask)]
+
+    def tile_value_range(self, tile):
+        """
+        Compute the value range of the formula result for one tile position.
+        """
+        result_data = self.evaluate_tile(tile)
+        if result_data.size:
+            return result_data.min(), result_data.max()
+
+    def value_range(self, ranges):
+        """
+        Reduce a list of value ranges into one.
+        """
+        ranges = [rng for rng in ranges if rng is not None]
+        if ranges:
+            return min(rng[0] for rng in ranges), max(rng[1] for rng in ranges)
+
+    def count_tile(self, tile):
+        """
+        Compute the partial counts for one tile position.
+        """
+        return self.count_values(self.evaluate_tile(tile))
+
+    def count_values(self, result_data):
+        """
+        Compute the partial counts for an array of values.
+        """
+        if self.grouping == 'discrete':
+            # Compute unique counts for discrete input data
+            return self.unique_counts(result_data)
+
+        elif self.grouping == 'continuous':
+            # Compute histogram on unmasked data with the fixed bins
+            return numpy.histogram(result_data, bins=self.histogram_bins, range=self.histogram_range)[0]
+
+        else:
+            # Evaluate the legend expressions on the unique values only
+            return self.count_legend(*self.unique_counts(result_data))
+
+    def unique_counts(self, data):
+        """
+        Compute the unique values of the data and their counts. Integer data
+        up to 16 bit is counted in a single pass with bincount.
+        """
+        if data.dtype.kind in ('b', 'u', 'i') and data.dtype.itemsize <= 2:
+            offset = numpy.iinfo(data.dtype).min if data.dtype.kind == 'i' else 0
+            counts = numpy.bincount(data.astype('int32') - offset if offset else data)
+            values = numpy.flatnonzero(counts)
+            return (values + offset).astype(data.dtype), counts[values]
+        return numpy.unique(data, return_counts=True)
+
+    def count_legend(self, values, counts):
+        """
+        Sum up the counts of the values matching each of the legend expressions.
+        """
+        result = []
+        for key, value in zip(self.legend_keys, self.legend_values):
+            if value is not None:
+                selector = values == value
+            else:
+                # Use the key as numpy expression
+                selector = self.parser.evaluate_formula(key, {'x': values})
+            result.append(numpy.sum(counts[selector]))
+        return numpy.array(result)
+
+    def count_summary(self, summary):
+        """
+        Compute the partial counts for one tile from stored value counts.
+        """
+        values, counts = summary
+        if self.grouping == 'discrete':
+            return values, counts
+        return self.count_legend(values, counts)
+
+    def merge(self, partials):
+        """
+        Reduce a list of partial counts into one.
+        """
+        partials = [partial for partial in partials if partial is not None]
+        if not partials:
+            return
+
+        if self.grouping == 'continuous' or isinstance(self.grouping, int):
+            # Histogram and legend counts are aligned to the bins and keys
+            return sum(partials)
+
+        # Sum up counts for unique values
+        keys = numpy.concatenate([partial[0] for partial in partials])
+        counts = numpy.concatenate([partial[1] for partial in partials])
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        merged = numpy.zeros(len(keys), dtype=counts.dtype)
+        numpy.add.at(merged, inverse, counts)
+
+        return keys, merged
+
+    def remaining(self, deadline):
+        """
+        Return the remaining time in seconds until the deadline.
+        """
+        if deadline is None:
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RasterAggregationException('Aggregation timed out.')
+        return remaining
+
+    def iter_tiles(self, func, merge, deadline):
+        """
+        Generator applying a function to all tiles of the tile range. The
+        results are merged for each block, and yielded together with the
+        number of tile positions in that block. The tiles are read block by
+        block with tile_blocks. With multiple workers, the next block is
+        fetched while the current one is evaluated, so the rasters of two
+        blocks are held in memory.
+        """
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+            try:
+                # Evaluate the tiles of a block in the pool while the next
+                # block is fetched from the database
+                pending = None
+                for positions, block in self.tile_blocks(self.tilerange):
+                    job = (positions, pool.map_async(func, block))
+                    if pending:
+                        yield pending[0], merge(pending[1].get(self.remaining(deadline)))
+                    pending = job
+                if pending:
+                    yield pending[0], merge(pending[1].get(self.remaining(deadline)))
+            except PoolTimeoutError:
+                raise RasterAggregationException('Aggregation timed out.')
+            finally:
+                pool.terminate()
+        else:
+            for positions, block in self.tile_blocks(self.tilerange):
+                results = []
+                for data in block:
+                    self.remaining(deadline)
+                    results.append(func(data))
+                yield positions, merge(results)
+
+    def map_tiles(self, func, merge, deadline):
+        """
+        Apply a function to all tiles of the tile range and return the list
+        of results merged for each block.
+        """
+        return [result for positions, result in self.iter_tiles(func, merge, deadline)]
+
+    def get_bin_edges(self, deadline):
+        """
+        Setup the histogram bins for continuous grouping and return the bin
+        edges. If the number of bins is given, the bins span the value range
+        from the band metadata for formulas with a single layer name, otherwise
+        the value range is computed in a first pass over the tiles. Returns
+        None if there is no data.
+        """
+        if not isinstance(self.bins, int):
+            # Use bin edges as given
+            self.histogram_bins = numpy.array(self.bins, dtype='float64')
+            self.histogram_range = None
+            return self.histogram_bins
+
+        value_range = self.stored_value_range()
+        if value_range is None:
+            value_range = self.value_range(self.map_tiles(self.tile_value_range, self.value_range, deadline))
+            if value_range is None:
+                return
+
+        self.histogram_bins = self.bins
+        self.histogram_range = value_range
+
+        # Compute the bin edges in the pixel type of the value range
+        return numpy.histogram(numpy.array(value_range)[:0], bins=self.bins, range=value_range)[1]
+
+    def setup(self):
+        """
+        Compute the tile range and prepare the clip geometry for evaluating
+        the tiles. Returns False if the aggregation area does not overlap
+        with the layers.
+        """
+        # Reject aggregations that exceed the tile budget
+        self.admit()
+
+        # Compute tilerange for this area and the given zoom level
+        tilerange = self.tilerange = self.get_tilerange()
+        if tilerange is None:
+            return False
+
+        if self.geom:
+            # Classify tiles into interior, boundary and exterior tiles
+            self.tile_classes = self.classify_tiles(tilerange)
+
+            # Rasterize the clip geometry once for the whole tile range if
+            # possible, otherwise it is rasterized for every boundary tile
+            self.ogr_geom = OGRGeometry(self.geom.ewkt)
+            self.geom_mask = None
+            if not all(self.tile_classes.values()):
+                self.geom_mask = self.rasterize_geom(tilerange)
+
+        self.summaries = {}
+        return True
+
+    def value_count(self):
+        """
+        Compute the value count for this aggregation.
+        """
+        for done, total, result in self.iter_value_count():
+            pass
+        return result
+
+    def iter_value_count(self, every=None):
+        """
+        Generator computing the value count for this aggregation step by step.
+        Yields tuples with the number of tile positions done, the total number
+        of tile positions and the cumulative value count so far.
+
+        If every is given, a partial value count is yielded as soon as at
+        least that many tile positions were evaluated since the last one. The
+        tiles are evaluated block by block, so partial counts are yielded at
+        most once per block. The final value count is always yielded last.
+        """
+        if not self.setup():
+            yield 0, 0, {}
+            return
+
+        # Use stored value counts where possible
+        self.summaries = self.get_summaries(self.tilerange)
+
+        deadline = time.time() + self.timeout if self.timeout else None
+
+        # Setup fixed histogram bins for continuous grouping
+        if self.grouping == 'continuous':
+            self.bin_edges = self.get_bin_edges(deadline)
+            if self.bin_edges is None:
+                yield 0, 0, {}
+                return
+
+        acres = bool(self.acres and self.geom)
+        total = self.tile_count(self.tilerange)
+
+        merged = self.merge([self.count_summary(summary) for summary in self.summaries.values()])
+        done = reported = len(self.summaries)
+
+        for positions, partial in self.iter_tiles(self.count_tile, self.merge, deadline):
+            merged = self.merge([merged, partial])
+            done += positions
+            if every and done - reported >= every and done < total:
+                reported = done
+                yield done, total, self.format_counts(merged, acres=acres)
+
+        yield total, total, self.format_counts(merged, acres=acres)
+
+    def format_counts(self, merged, acres=False):
+        """
+        Convert merged partial counts into the value count dictionary, with
+        the counts transformed into acres if requested.
+        """
+        # Reduce partial counts into result dictionary
+        results = Counter({})
+        if merged is not None:
+            if isinstance(self.grouping, int):
+                merged = (self.legend_keys, merged)
+            elif self.grouping == 'continuous':
+                merged = (zip(self.bin_edges[:-1], self.bin_edges[1:]), merged)
+            for key, count in zip(*merged):
+                results[key] += count
+
+        # Drop empty counts
+        results = {k: v for k, v in results.items() if v > 0}
+
+        # Transform pixel count to acres if requested, otherwise scale the
+        # pixel count to the max zoom level
+        scaling_factor = self.count_scale
+        if acres and len(results):
+            scaling_factor = tile_scale(self.zoom) ** 2 * 0.000247105381
+
+        return {
+            str(int(k) if isinstance(k, numpy.floating) and int(k) == k else k):
+            v * scaling_factor for k, v in results.items()
+        }
+
+    def tile_moments(self, tile):
+        """
+        Compute the pixel count, mean, sum of squared deviations from the mean,
+        min, max and the histogram counts for percentiles for one tile position.
+        """
+        data = self.evaluate_tile(tile)
+        if not data.size:
+            return
+
+        hist = None
+        if self.percentiles:
+            hist = numpy.histogram(data, bins=self.histogram_bins, range=self.histogram_range)[0]
+
+        data = data.astype('float64')
+        mean = data.mean()
+        return data.size, mean, numpy.sum((data - mean) ** 2), data.min(), data.max(), hist
+
+    def merge_moments(self, partials):
+        """
+        Reduce a list of partial moments into one, using the pairwise update
+        for the mean and the sum of squared deviations.
+        """
+        partials = [partial for partial in partials if partial is not None]
+        if not partials:
+            return
+
+        count, mean, m2, vmin, vmax, hist = partials[0]
+        for n, m, s, lo, hi, h in partials[1:]:
+            delta = m - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += s + delta ** 2 * count * n / total
+            count = total
+            vmin = min(vmin, lo)
+            vmax = max(vmax, hi)
+            if hist is not None:
+                hist = hist + h
+
+        return count, mean, m2, vmin, vmax, hist
+
+    def parse_statistics(self, stats):
+        """
+        Set the statistics names and parse the percentiles from them.
+        """
+        self.stats = stats
+        self.percentiles = {}
+        for stat in stats:
+            try:
+                if stat.startswith('percentile_'):
+                    self.percentiles[stat] = float(stat[len('percentile_'):])
+                elif stat not in STATISTICS:
+                    raise ValueError
+            except ValueError:
+                raise RasterAggregationException('Invalid statistic {0}.'.format(stat))
+
+    def statistics(self, stats=None):
+        """
+        Compute summary statistics of the pixel values for this aggregation.
+        The statistics default to the ones passed to the constructor.
+        """
+        if stats is None:
+            stats = STATISTICS if self.stats is None else self.stats
+        self.parse_statistics(stats)
+
+        # Result for areas without data
+        empty = {stat: 0 if stat == 'count' else None for stat in stats}
+
+        if not self.setup():
+            return empty
+
+        deadline = time.time() + self.timeout if self.timeout else None
+
+        # Setup fixed histogram bins for percentiles
+        if self.percentiles:
+            bin_edges = self.get_bin_edges(deadline)
+            if bin_edges is None:
+                return empty
+
+        merged = self.merge_moments(self.map_tiles(self.tile_moments, self.merge_moments, deadline))
+        if merged is None:
+            return empty
+
+        count, mean, m2, vmin, vmax, hist = merged
+        values = {
+            'count': int(count * self.count_scale),
+            'sum': float(mean * count * self.count_scale),
+            'mean': float(mean),
+            'min': float(vmin),
+            'max': float(vmax),
+            'std': float(numpy.sqrt(m2 / count)),
+        }
+
+        # Interpolate percentiles from the cumulative histogram
+        if self.percentiles:
+            cumulative = numpy.concatenate([[0], numpy.cumsum(hist)])
+            for stat, q in self.percentiles.items():
+                values[stat] = float(numpy.interp(q / 100 * cumulative[-1], cumulative, bin_edges))
+
+        return {stat: values[stat] for stat in stats}
+
+
+def aggregation_cache_key(layer_dict, formula, geom, **params):
+    """
+    Compute the cache key for an aggregation. The key contains the modified
+    timestamps of the layers, so that results are invalidated when a layer
+    is changed or reparsed.
+    """
+    from .models import RasterLayer
+
+    # Get layer modification timestamps
+    modified = dict(RasterLayer.objects.filter(id__in=layer_dict.values()).values_list('id', 'modified'))
+    layers = sorted((name, int(layerid), str(modified.get(int(layerid)))) for name, layerid in layer_dict.items())
+
+    # Use the binary representation of the geometry
+    if geom is not None:
+        if not isinstance(geom, GEOSGeometry):
+            geom = GEOSGeometry(geom)
+        geom = hashlib.md5(bytes(geom.ewkb)).hexdigest()
+
+    key = repr((layers, RasterAlgebraParser().clean_formula(formula or ''), geom, sorted(params.items())))
+
+    return 'raster_aggregation_' + hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def aggregator(layer_dict, zoom=None, geom=None, formula=None, acres=True, grouping='auto', dtype=None,
+               workers=None, timeout=None, bins=10, max_tiles=None, max_error=None):
     """
     Compute aggregate statistics for a layers dictionary, potentially for
     an algebra expression and clipped by a geometry.
@@ -70,153 +963,245 @@ def aggregator(layer_dict, zoom=None, geom=None, formula=None, acres=True, group
     * 'auto' (the default). The output will be grouped by unique values if all
       input rasters are discrete, otherwise a numpy histogram is used.
     * 'discrete' groups the data will be grouped by unique values
-    * 'continuous' groups the data in a numpy histogram
+    * 'continuous' groups the data in a numpy histogram with fixed bins
     * If an integer value is passed to the argument, it is interpreted as a
       legend_id. The data will be grouped using the legend expressions. For
       For instance, use grouping=23 for grouping the output with legend 23.
+
+    The dtype parameter overrides the pixel type used for evaluating the
+    algebra expression, by default the pixel type is derived from the input.
+
+    The bins parameter is used for continuous grouping. It is either the
+    number of equal width bins spanning the value range, or a sequence of bin
+    edges. The value range is taken from the band metadata if the formula is
+    a single layer, otherwise it is computed from the data.
+
+    If no zoom level is specified, the aggregation is computed at the max
+    zoom level of the layers. To compute a faster approximation on a coarser
+    zoom level, specify a max_tiles budget for the number of tiles to read, or
+    a max_error target for the estimated relative error of the pixel counts.
+    The pixel counts are then scaled to the resolution of the max zoom. Use
+    the Aggregator class directly to obtain the selected zoom and the error
+    estimate from its zoom and error attributes.
+
+    The RASTER_AGGREGATION_MAX_TILES setting limits the number of tiles read
+    by one aggregation, counting one tile per layer and tile position. If no
+    zoom level is specified, a coarser zoom level is selected to stay within
+    this budget, otherwise a RasterAggregationException is raised. Use the
+    aggregation_estimate function to estimate the work before aggregating.
+
+    Results are cached if the RASTER_AGGREGATION_CACHE setting specifies the
+    name of a cache backend. Cached results are invalidated when any of the
+    layers is modified or reparsed.
+
+    The workers parameter sets the number of threads used for evaluating
+    the tiles, the timeout parameter limits the total aggregation time in
+    seconds. The defaults are taken from the RASTER_AGGREGATION_WORKERS and
+    RASTER_AGGREGATION_TIMEOUT settings.
     """
-    from .models import RasterLayer, RasterTile, Legend
+    # Get cache for aggregation results if configured
+    cache_alias = getattr(settings, 'RASTER_AGGREGATION_CACHE', None)
+    if cache_alias:
+        cache = caches[cache_alias]
+        key = aggregation_cache_key(
+            layer_dict, formula, geom, zoom=zoom, acres=acres, grouping=grouping, dtype=dtype, bins=bins,
+            max_tiles=max_tiles, max_error=max_error, budget=getattr(settings, 'RASTER_AGGREGATION_MAX_TILES', None)
+        )
+        result = cache.get(key)
+        if result is not None:
+            return result
 
-    algebra_parser = RasterAlgebraParser()
+    result = Aggregator(
+        layer_dict, formula, zoom=zoom, geom=geom, acres=acres, grouping=grouping, dtype=dtype,
+        workers=workers, timeout=timeout, bins=bins, max_tiles=max_tiles, max_error=max_error
+    ).value_count()
 
-    # Get layers
-    layers = RasterLayer.objects.filter(id__in=layer_dict.values())
+    if cache_alias:
+        cache.set(key, result, getattr(settings, 'RASTER_AGGREGATION_CACHE_TIMEOUT', 60 * 60 * 24))
 
-    # Compute zoom if not provided
-    if zoom is None:
-        zoom = min(layers.values_list('metadata__max_zoom', flat=True))
+    return result
 
-    # Compute tilerange for this area and the given zoom level
-    if geom:
-        # Transform geom to web mercator
-        if geom.srid != WEB_MERCATOR_SRID:
-            geom.transform(WEB_MERCATOR_SRID)
 
-        # Clip against max extent for limiting nr of tiles.
-        # This is important for requests on large areas for small rasters.
-        max_extent = MultiPolygon([Polygon.from_bbox(lyr.extent()) for lyr in layers]).envelope
-        max_extent = geom.intersection(max_extent)
+def aggregation_estimate(layer_dict, zoom=None, geom=None, formula=None, grouping='auto', dtype=None, bins=10,
+                         max_tiles=None, max_error=None, stats=None):
+    """
+    Estimate the work for an aggregation without evaluating any tiles. Returns
+    a dictionary with the zoom level, the number of tile positions, the
+    number of layers, the number of passes over the tiles, the number of
+    tiles to read and the estimated relative error. The parameters are used
+    as for the aggregator function. If a list of statistics names is given,
+    the estimate is for summary statistics as computed by zonal_stats.
+    """
+    if stats is not None:
+        grouping = 'continuous'
+    return Aggregator(
+        layer_dict, formula, zoom=zoom, geom=geom, grouping=grouping, dtype=dtype, bins=bins,
+        max_tiles=max_tiles, max_error=max_error, stats=stats
+    ).estimate()
 
-        # Abort if there is no spatial overlay
-        if max_extent.empty:
-            return {}
 
-        # Compute tile index range for geometry and given zoom level
-        tilerange = tile_index_range(max_extent.extent, zoom)
-    else:
-        # Get index range set for the input layers
-        index_ranges = [tile_index_range(lyr.extent(), zoom) for lyr in layers]
-
-        # Compute intersection of index ranges
-        tilerange = [
-            max([dat[0] for dat in index_ranges]),
-            max([dat[1] for dat in index_ranges]),
-            min([dat[2] for dat in index_ranges]),
-            min([dat[3] for dat in index_ranges])
-        ]
-
-    # Auto determine grouping based on input data
-    if grouping == 'auto':
-        all_discrete = all([lyr.datatype in ['ca', 'ma'] for lyr in layers])
-        grouping = 'discrete' if all_discrete else 'continuous'
-    elif grouping in ('discrete', 'continuous'):
-        pass
-    else:
-        # Try converting the grouping input to int
-        try:
-            grouping = int(grouping)
-        except:
-            raise RasterAggregationException(
-                'Invalid grouping value found for valuecount.'
-            )
+def zonal_stats(layer_dict, formula, stats=STATISTICS, zoom=None, geom=None, dtype=None, workers=None, timeout=None,
+                bins=100):
+    """
+    Compute summary statistics of the pixel values for a layers dictionary,
+    potentially for an algebra expression and clipped by a geometry. The
+    tiles are evaluated in a single pass, percentiles require a first pass to
+    compute the value range if it is not known from the band metadata.
 
-    # Loop through tiles and evaluate raster algebra for each tile
-    results = Counter({})
-    rastgeom = None
-    for tilex in range(tilerange[0], tilerange[2] + 1):
-        for tiley in range(tilerange[1], tilerange[3] + 1):
-
-            # Prepare a data dictionary with named tiles for algebra evaluation
-            data = {}
-            for name, layerid in layer_dict.items():
-                tile = RasterTile.objects.filter(
-                    tilex=tilex,
-                    tiley=tiley,
-                    tilez=zoom,
-                    rasterlayer_id=layerid
-                ).first()
-                if tile:
-                    data[name] = tile.rast
-                else:
-                    break
+    The stats parameter is a list of statistics names. Allowed are 'count',
+    'sum', 'mean', 'min', 'max' and 'std', and percentiles specified as
+    'percentile_q', where q is a number between 0 and 100. For instance,
+    'percentile_50' computes the median.
+
+    Percentiles are interpolated from a histogram of the values. The bins
+    parameter sets the number of histogram bins, or the bin edges. The other
+    parameters are used as for the aggregator function.
+    """
+    return Aggregator(
+        layer_dict, formula, zoom=zoom, geom=geom, acres=False, grouping='continuous', dtype=dtype,
+        workers=workers, timeout=timeout, bins=bins, stats=stats
+    ).statistics()
+
+
+class ZonalAggregator(Aggregator):
+    """
+    Compute value counts for many geometries in one pass over the tiles.
+
+    The geometries that overlap with a tile are rasterized into a zone raster
+    for that tile, using the index of each geometry as burn value. The pixel
+    values of the tile are then counted separately for each zone.
+    """
+    def __init__(self, layer_dict, formula, geoms, **kwargs):
+        super(ZonalAggregator, self).__init__(layer_dict, formula, **kwargs)
+
+        # Convert list input to dictionary with indices as feature ids
+        if not isinstance(geoms, dict):
+            geoms = dict(enumerate(geoms))
+        self.feature_ids = list(geoms.keys())
 
-            # Ignore this tile if it is missing in any of the input layers
-            if len(data) < len(layer_dict):
+        # Transform geometries to web mercator
+        self.geoms = []
+        for feature_id in self.feature_ids:
+            geom = geoms[feature_id]
+            if not isinstance(geom, GEOSGeometry):
+                geom = GEOSGeometry(geom)
+            if geom.srid != WEB_MERCATOR_SRID:
+                geom = geom.transform(WEB_MERCATOR_SRID, clone=True)
+            self.geoms.append(geom)
+
+        # Use the smallest pixel type that can hold all burn values
+        self.zone_datatype = 2 if len(self.geoms) < 2 ** 16 else 4
+
+    def setup(self):
+        """
+        Compute the tile range of the layers and the geometries that overlap
+        with each tile.
+        """
+        self.admit()
+
+        tilerange = self.tilerange = self.get_tilerange()
+        self.summaries = {}
+
+        # Find the tiles within the bounding box of each geometry
+        self.tile_classes = {}
+        for index, geom in enumerate(self.geoms):
+            if geom.empty:
                 continue
+            geomrange = tile_index_range(geom.extent, self.zoom)
+            for tilex in range(max(geomrange[0], tilerange[0]), min(geomrange[2], tilerange[2]) + 1):
+                for tiley in range(max(geomrange[1], tilerange[1]), min(geomrange[3], tilerange[3]) + 1):
+                    self.tile_classes.setdefault((tilex, tiley), []).append(index)
 
-            # Evaluate algebra on tiles
-            result = algebra_parser.evaluate_raster_algebra(data, formula)
+        self.ogr_geoms = [OGRGeometry(geom.ewkt) for geom in self.geoms]
 
-            # Get resulting array masked with na values
-            result_data = numpy.ma.masked_values(
-                result.bands[0].data(),
-                result.bands[0].nodata_value
-            )
+        return len(self.tile_classes) > 0
 
-            # Apply rasterized geometry as mask if clip geometry was provided
-            if geom:
-                # Rasterize the aggregation area to the result raster
-                rastgeom = rasterize(geom, result)
+    def count_tile(self, tile):
+        """
+        Compute the partial counts for each zone of one tile position.
+        """
+        tilex, tiley, data = tile
 
-                # Get boolean mask based on rasterized geom
-                rastgeom_mask = rastgeom.bands[0].data() != 1
-
-                # Apply geometry mask to result data
-                result_data.mask = result_data.mask | rastgeom_mask
-
-            if grouping == 'discrete':
-                # Compute unique counts for discrete input data
-                unique_counts = numpy.unique(result_data.compressed(), return_counts=True)
-                # Add counts to results
-                values = dict(zip(unique_counts[0], unique_counts[1]))
-
-            elif grouping == 'continuous':
-                # Handle continuous case - compute histogram on masked (compresed) data
-                counts, bins = numpy.histogram(result_data.compressed())
-
-                # Create dictionary with bins as keys and histogram counts as values
-                values = {}
-                for i in range(len(bins) - 1):
-                    values[(bins[i], bins[i + 1])] = counts[i]
-
-            elif isinstance(grouping, int):
-                # Use legend to compute value counts
-                formula_parser = FormulaParser()
-                legend = Legend.objects.get(id=grouping)
-                values = {}
-                for key, color in legend.colormap.items():
-                    try:
-                        # Try to use the key as number directly
-                        selector = result_data == float(key)
-                    except ValueError:
-                        # Otherwise use it as numpy expression directly
-                        selector = formula_parser.evaluate_formula(key, {'x': result_data})
-                    values[key] = numpy.sum(selector)
-
-            # Add counts to results
-            results += Counter(values)
-
-    # Transform pixel count to acres if requested
-    scaling_factor = 1
-    if acres and rastgeom and len(results):
-        scaling_factor = abs(rastgeom.scale.x * rastgeom.scale.y) * 0.000247105381
-
-    results = {
-        str(int(k) if type(k) == numpy.float64 and int(k) == k else k):
-        v * scaling_factor for k, v in results.items()
-    }
-
-    return results
+        # Evaluate algebra on tiles, get flat result array and nodata mask
+        result_data, result_mask = self.parser.evaluate_raster_algebra_array(data, self.formula, dtype=self.dtype)
+
+        # Rasterize the zones overlapping with this tile
+        indices = self.tile_classes[(tilex, tiley)]
+        zones = rasterize_zones(
+            [self.ogr_geoms[index] for index in indices],
+            list(data.values())[0],
+            [index + 1 for index in indices],
+            datatype=self.zone_datatype,
+        ).bands[0].data().ravel()
+
+        # Drop masked pixels and pixels outside of the zones
+        valid = numpy.logical_not(result_mask) & (zones > 0)
+        if not numpy.any(valid):
+            return {}
+
+        # Sort the values by zone and count them for each zone
+        zones = zones[valid]
+        order = numpy.argsort(zones, kind='mergesort')
+        zones = zones[order]
+        values = result_data[valid][order]
+        splits = numpy.flatnonzero(numpy.diff(zones)) + 1
+        starts = numpy.concatenate([[0], splits])
+
+        return {
+            int(zones[start]) - 1: self.count_values(zone_values)
+            for start, zone_values in zip(starts, numpy.split(values, splits))
+        }
+
+    def merge_zones(self, partials):
+        """
+        Reduce a list of partial zone counts into one.
+        """
+        zones = {}
+        for partial in partials:
+            for index, counts in partial.items():
+                zones.setdefault(index, []).append(counts)
+        return {index: self.merge(counts) for index, counts in zones.items()}
+
+    def value_count(self):
+        """
+        Compute the value counts for each geometry, keyed by feature id.
+        """
+        if not self.setup():
+            return {feature_id: {} for feature_id in self.feature_ids}
+
+        deadline = time.time() + self.timeout if self.timeout else None
+
+        # Setup fixed histogram bins for continuous grouping
+        if self.grouping == 'continuous':
+            self.bin_edges = self.get_bin_edges(deadline)
+            if self.bin_edges is None:
+                return {feature_id: {} for feature_id in self.feature_ids}
+
+        zones = self.merge_zones(self.map_tiles(self.count_tile, self.merge_zones, deadline))
+
+        return {
+            feature_id: self.format_counts(zones.get(index), acres=self.acres)
+            for index, feature_id in enumerate(self.feature_ids)
+        }
+
+
+def zonal_aggregator(layer_dict, geoms, zoom=None, formula=None, acres=True, grouping='auto', dtype=None,
+                     workers=None, timeout=None, bins=10):
+    """
+    Compute value counts for many geometries in a single pass over the tiles.
+
+    The geoms argument is either a dictionary of geometries keyed by feature
+    id, or a list of geometries in which case the list indices are used as
+    feature ids. The result is a dictionary with the value counts of each
+    geometry, keyed by feature id. Geometries should not overlap, pixels in
+    overlapping parts are only counted for one of the geometries.
+
+    The other parameters are used as for the aggregator function.
+    """
+    return ZonalAggregator(
+        layer_dict, formula, geoms, zoom=zoom, acres=acres, grouping=grouping, dtype=dtype,
+        workers=workers, timeout=timeout, bins=bins
+    ).value_count()
 
 
 class ValueCountMixin(object):
@@ -237,30 +1222,31 @@ class ValueCountMixin(object):
                 'calculated for categorical or mask raster tpyes'
             )
 
+        version = self.metadata.tile_version
+        params = {'rasterlayer_id': self.id, 'version': version, 'zoom': zoom}
+
         if geom:
             # Make sure geometry is GEOS Geom
             geom = GEOSGeometry(geom)
 
-            sql = CLIPPED_VALUE_COUNT_SQL.format(
-                geom_ewkt=geom.ewkt,
-                geom_srid=geom.srid,
-                rast_srid=WEB_MERCATOR_SRID,
-                rasterlayer_id=self.id,
-                zoom=zoom
-            )
+            # The geometry is transformed once, tiles are clipped in their
+            # native projection.
+            sql = CLIPPED_VALUE_COUNT_SQL
+            params.update(geom_ewkt=geom.ewkt, rast_srid=WEB_MERCATOR_SRID)
+        elif not self.rastertile_set.filter(version=version, tilez=zoom, valuecount__isnull=True).exists():
+            # Sum up the value counts stored for each tile
+            sql = SUMMARY_VALUE_COUNT_SQL
         else:
-            sql = GLOBAL_VALUE_COUNT_SQL.format(
-                rasterlayer_id=self.id,
-                zoom=zoom
-            )
+            sql = GLOBAL_VALUE_COUNT_SQL
 
         cursor = connection.cursor()
-        cursor.execute(sql)
+        cursor.execute(sql, params)
 
-        # Convert value count to areas if requested
+        # Convert value count to areas if requested, counts are in pixels of
+        # the web mercator tiles at this zoom level.
         if area:
-            scalex, scaley = self._min_pixelsize(geom.srid)
-            return {int(row[0]): int(row[1]) * scalex * scaley for row in cursor.fetchall()}
+            pixelarea = tile_scale(zoom) ** 2
+            return {int(row[0]): int(row[1]) * pixelarea for row in cursor.fetchall()}
         else:
             return {int(row[0]): int(row[1]) for row in cursor.fetchall()}
 
@@ -273,7 +1259,7 @@ class ValueCountMixin(object):
         """
         if not self._maxz:
             cursor = connection.cursor()
-            cursor.execute(MAX_ZOOM_SQL.format(rasterlayer_id=self.id))
+            cursor.execute(MAX_ZOOM_SQL, {'rasterlayer_id': self.id, 'version': self.metadata.tile_version})
             self._maxz = cursor.fetchone()[0]
         return self._maxz
 
@@ -284,16 +1270,19 @@ class ValueCountMixin(object):
         if not zoom:
             zoom = self._max_zoom
 
-        sql = MINSIZE_SQL.format(
-            srid=srid,
-            rasterlayer_id=self.id,
-            zoom=zoom
-        )
-
-        cursor = connection.cursor()
-        cursor.execute(sql)
-        res = cursor.fetchone()
-        self._minsize = (abs(res[0]), abs(res[1]))
+        # Pixels of the tiles have the tile scale in web mercator
+        scale = tile_scale(zoom)
+        if srid == WEB_MERCATOR_SRID:
+            self._minsize = (scale, scale)
+        else:
+            # Transform a single pixel at the center of the layer
+            xmin, ymin, xmax, ymax = self.extent()
+            x = (xmin + xmax) / 2
+            y = (ymin + ymax) / 2
+            pixel = OGRGeometry(Envelope((x, y, x + scale, y + scale)).wkt, srs=WEB_MERCATOR_SRID)
+            pixel.transform(srid)
+            xmin, ymin, xmax, ymax = pixel.extent
+            self._minsize = (abs(xmax - xmin), abs(ymax - ymin))
         self._minsize_srid = srid
 
         return self._minsize
@@ -307,3 +1296,15 @@ class ValueCountMixin(object):
         formula = 'a'
 
         return aggregator(ids, zoom, geom, formula, acres=area)
+
+    def zonal_value_count(self, geoms, area=False, zoom=None):
+        """
+        Compute value counts or histograms for many geometries at once.
+        """
+        return zonal_aggregator({'a': self.id}, geoms, zoom=zoom, formula='a', acres=area)
+
+    def zonal_stats(self, geom=None, stats=STATISTICS, zoom=None):
+        """
+        Compute summary statistics for rasterlayers within a geometry.
+        """
+        return zonal_stats({'a': self.id}, 'a', stats=stats, zoom=zoom, geom=geom)
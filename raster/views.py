@@ -1,18 +1,25 @@
 import json
+from functools import reduce
+from operator import or_
 
 import numpy
 from PIL import Image
+from pyparsing import ParseException
 
 from django.conf import settings
-from django.http import Http404, HttpResponse
+from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.db.models import Q
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import six
 from django.views.generic import View
-from raster.const import WEB_MERCATOR_TILESIZE
+from raster.const import AGGREGATION_VIEW_MAX_TILES, AGGREGATION_VIEW_TIMEOUT, WEB_MERCATOR_TILESIZE
 from raster.formulas import RasterAlgebraParser
-from raster.models import Legend, RasterLayer, RasterTile
-from raster.tiler import tile_bounds, tile_scale
-from raster.utils import IMG_FORMATS, band_data_to_image, hex_to_rgba
+from raster.models import Legend, RasterLayer, RasterLayerBandMetadata, RasterLayerMetadata, RasterTile
+from raster.tiler import morton_key, morton_parent, tile_bounds, tile_scale
+from raster.utils import IMG_FORMATS, band_data_to_grayscale, band_data_to_image, hex_to_rgba
+from raster.valuecount import Aggregator, RasterAggregationException
 
 
 class RasterView(View):
@@ -88,42 +95,114 @@ class RasterView(View):
         tiley = int(self.kwargs.get('y'))
         tilez = int(self.kwargs.get('z'))
 
-        # Loop through zoom levels to search for a tile
-        result = None
+        # Get the current tile version and the index ranges of the layer to
+        # skip zoom levels without tiles
+        meta = RasterLayerMetadata.objects.filter(rasterlayer_id=layer_id).first()
+
+        # Collect the Morton keys of the tile and its parents at all zoom
+        # levels, skipping zoom levels that have no tile at this position
+        key = morton_key(tilex, tiley)
+        query = []
         for zoom in range(tilez, -1, -1):
             # Compute multiplier to find parent raster
             multiplier = 2 ** (tilez - zoom)
-            # Fetch tile
-            tile = RasterTile.objects.filter(
-                tilex=tilex / multiplier,
-                tiley=tiley / multiplier,
-                tilez=zoom,
-                rasterlayer_id=layer_id
-            )
 
-            if tile.exists():
-                # Extract raster from tile model
-                result = tile[0].rast
-                # If the tile is a parent of the original, warp it to the
-                # original request tile.
-                if zoom < tilez:
-                    # Compute bounds, scale and size of child tile
-                    bounds = tile_bounds(tilex, tiley, tilez)
-                    tilesize = int(getattr(settings, 'RASTER_TILESIZE', WEB_MERCATOR_TILESIZE))
-                    tilescale = tile_scale(tilez)
-
-                    # Warp parent tile to child tile
-                    result = result.warp({
-                        'width': tilesize,
-                        'height': tilesize,
-                        'scale': [tilescale, -tilescale],
-                        'origin': [bounds[0], bounds[3]],
-                    })
-
-                break
+            if meta and meta.index_ranges is not None:
+                index_range = meta.index_range(zoom)
+                if not index_range:
+                    continue
+                inside_x = index_range[0] <= tilex // multiplier <= index_range[2]
+                inside_y = index_range[1] <= tiley // multiplier <= index_range[3]
+                if not inside_x or not inside_y:
+                    continue
+
+            query.append(Q(tilez=zoom, morton=morton_parent(key, tilez, zoom)))
+
+        if not query:
+            return
+
+        # Fetch the tile at the highest available zoom level in one query
+        tile = RasterTile.objects.filter(
+            reduce(or_, query),
+            rasterlayer_id=layer_id,
+            version=meta.tile_version if meta else 0,
+        ).order_by('-tilez').first()
+
+        if tile is None:
+            return
+
+        # Extract raster from tile model
+        result = tile.rast
+        # If the tile is a parent of the original, warp it to the
+        # original request tile.
+        if tile.tilez < tilez:
+            result = self.overzoom(result, tilex, tiley, tilez, tile.tilez)
 
         return result
 
+    def overzoom(self, parent, tilex, tiley, tilez, zoom):
+        """
+        Resample a parent tile to the requested child tile using nearest
+        neighbour resampling.
+
+        If the parent tile is aligned with the tile grid, the child quadrant
+        is sliced from the pixel data and upsampled in numpy. Otherwise the
+        parent tile is warped to the child tile with GDAL.
+        """
+        # Compute bounds, scale and size of child tile
+        bounds = tile_bounds(tilex, tiley, tilez)
+        tilesize = int(getattr(settings, 'RASTER_TILESIZE', WEB_MERCATOR_TILESIZE))
+        tilescale = tile_scale(tilez)
+
+        # Check if the parent pixels are aligned with the child tile
+        multiplier = 2 ** (tilez - zoom)
+        parent_bounds = tile_bounds(tilex // multiplier, tiley // multiplier, zoom)
+        tolerance = tilescale / 1e6
+        aligned = all((
+            parent.width == tilesize,
+            parent.height == tilesize,
+            tilesize % multiplier == 0,
+            abs(parent.origin.x - parent_bounds[0]) < tolerance,
+            abs(parent.origin.y - parent_bounds[3]) < tolerance,
+            abs(parent.scale.x - tile_scale(zoom)) < tolerance,
+        ))
+
+        if not aligned:
+            # Warp parent tile to child tile
+            return parent.warp({
+                'width': tilesize,
+                'height': tilesize,
+                'scale': [tilescale, -tilescale],
+                'origin': [bounds[0], bounds[3]],
+            })
+
+        # Compute pixel offset and size of the child quadrant in the parent
+        size = tilesize // multiplier
+        offsetx = (tilex % multiplier) * size
+        offsety = (tiley % multiplier) * size
+
+        # Slice quadrant from parent bands and repeat pixels to tile size
+        bands = []
+        for band in parent.bands:
+            data = band.data(offset=(offsetx, offsety), size=(size, size))
+            data = data.repeat(multiplier, axis=0).repeat(multiplier, axis=1)
+            band_data = {'data': data}
+            if band.nodata_value is not None:
+                band_data['nodata_value'] = band.nodata_value
+            bands.append(band_data)
+
+        return GDALRaster({
+            'driver': 'MEM',
+            'width': tilesize,
+            'height': tilesize,
+            'origin': [bounds[0], bounds[3]],
+            'scale': [tilescale, -tilescale],
+            'srid': parent.srs.srid,
+            'datatype': parent.bands[0].datatype(),
+            'nr_of_bands': len(bands),
+            'bands': bands,
+        })
+
     def get_layer(self, data=None):
         """
         Gets layer from request data trying both name and id.
@@ -183,40 +262,84 @@ class AlgebraView(RasterView):
                 img = Image.new("RGBA", (WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), (0, 0, 0, 0))
                 return self.write_img_to_response(img, {})
 
-        # Get formula from request
+        # Get formula and optional pixel type from request
         formula = request.GET.get('formula')
+        dtype = request.GET.get('dtype', None)
 
         # Evaluate raster algebra expression, return 404 if not successfull
         try:
             # Evaluate raster algebra expression
-            result = self.parser.evaluate_raster_algebra(data, formula)
+            result, mask = self.parser.evaluate_raster_algebra_array(data, formula, dtype=dtype)
         except:
             raise Http404('Failed to evaluate raster algebra.')
 
-        # Get array from algebra result
-        result = result.bands[0].data()
+        # Reshape result array to tile size
+        orig = list(data.values())[0]
+        result = result.reshape(orig.height, orig.width)
 
         # Render tile
         colormap = self.get_colormap()
         if colormap:
+            # Set nodata value on masked pixels
+            nodata_value = orig.bands[0].nodata_value
+            if nodata_value is not None:
+                result[mask.reshape(result.shape)] = nodata_value
+
             # Render tile using the legend data
             img, stats = band_data_to_image(result, colormap)
         else:
-            # Scale to grayscale rgb (can be colorscheme later on)
-            result = result.astype('float').ravel()
-            result = 255 * (result - numpy.min(result)) / (numpy.max(result) - numpy.min(result))
-
-            # Create rgba matrix from grayscale array
-            result = numpy.array((result, result, result, numpy.repeat(255, len(result)))).T
-            rgba = result.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE, 4).astype('uint8')
-
-            # Create image from array
-            img = Image.fromarray(rgba)
+            # Render tile in grayscale, stretched between the requested bounds
+            vmin, vmax = self.get_stretch(ids, result, mask)
+            img = band_data_to_grayscale(result, vmin, vmax, mask)
             stats = {}
 
         # Return rendered image
         return self.write_img_to_response(img, stats)
 
+    def get_stretch(self, ids, result, mask):
+        """
+        Returns the value range for grayscale rendering. The range is either
+        given explicitly in the request ("stretch=min,max"), taken from the
+        band metadata of the layer ("stretch=metadata", optionally using
+        histogram percentiles with "percentiles=2,98") or computed from the
+        tile data.
+        """
+        stretch = self.request.GET.get('stretch', None)
+
+        if stretch is None:
+            # Stretch to value range of this tile
+            valid = result.ravel()[numpy.logical_not(mask)]
+            if not valid.size:
+                return 0, 0
+            return valid.min(), valid.max()
+        elif stretch == 'metadata':
+            # Metadata can only be used for a single layer
+            if len(ids) != 1:
+                raise Http404('Metadata stretch requires a single layer.')
+            # Use the band metadata of the latest parse
+            bandmeta = RasterLayerBandMetadata.objects.filter(
+                rasterlayer_id=list(ids.values())[0],
+                band=0,
+            ).order_by('-pk').first()
+            if bandmeta is None:
+                raise Http404('No band metadata found for layer.')
+
+            # Get stretch from histogram percentiles or band value range
+            percentiles = self.request.GET.get('percentiles', None)
+            if percentiles:
+                try:
+                    qmin, qmax = [float(q) for q in percentiles.split(',')]
+                except ValueError:
+                    raise Http404('Invalid percentiles.')
+                return bandmeta.percentile(qmin), bandmeta.percentile(qmax)
+            return bandmeta.min, bandmeta.max
+        else:
+            try:
+                vmin, vmax = [float(val) for val in stretch.split(',')]
+            except ValueError:
+                raise Http404('Invalid stretch.')
+            return vmin, vmax
+
 
 class TmsView(RasterView):
 
@@ -235,17 +358,15 @@ class TmsView(RasterView):
 
         # Render tile
         if tile and colormap:
-            if kwargs.get('masked', ''):
-                # Mask values
-                data = numpy.ma.masked_values(
-                    tile.bands[0].data(),
-                    tile.bands[0].nodata_value
-                )
-            else:
-                data = tile.bands[0].data()
+            data = tile.bands[0].data()
+
+            # Mask nodata values if requested
+            mask = None
+            if kwargs.get('masked', '') and tile.bands[0].nodata_value is not None:
+                mask = data == tile.bands[0].nodata_value
 
             # Render tile using the legend data
-            img, stats = band_data_to_image(data, colormap)
+            img, stats = band_data_to_image(data, colormap, mask)
         else:
             # Create empty image if tile cant be found
             img = Image.new("RGBA", (WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), (0, 0, 0, 0))
@@ -275,3 +396,141 @@ class LegendView(RasterView):
             raise Http404
 
         return HttpResponse(legend.json, content_type='application/json')
+
+
+class AggregationView(View):
+    """
+    A view to stream value counts of long running aggregations. The response
+    contains one json object per line with the number of tiles done, the
+    total number of tiles and the cumulative value count, so that clients
+    receive converging results before the aggregation is complete.
+
+    With "estimate=true", the view returns the estimated work for the
+    aggregation instead.
+
+    The view is public, so aggregations always have a tile budget and a
+    timeout. They default to AGGREGATION_VIEW_MAX_TILES and
+    AGGREGATION_VIEW_TIMEOUT if the RASTER_AGGREGATION_MAX_TILES and
+    RASTER_AGGREGATION_TIMEOUT settings are not specified.
+
+    The request is validated before streaming. Unknown layers and legends
+    result in a 404 response, an invalid formula or geometry results in a
+    400 response with the error as json.
+    """
+
+    def get(self, request):
+        # Parse layer ids into dictionary with variable names
+        try:
+            ids = request.GET.get('layers').split(',')
+            ids = {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
+        except (AttributeError, IndexError):
+            raise Http404('Invalid layers.')
+
+        # Get formula, defaults to the layer if only one is given
+        formula = request.GET.get('formula', None)
+        if formula is None:
+            if len(ids) != 1:
+                raise Http404('Formula is required for multiple layers.')
+            formula = list(ids.keys())[0]
+
+        # Check that all layers exist
+        try:
+            layer_ids = set(int(idx) for idx in ids.values())
+        except ValueError:
+            raise Http404('Invalid layers.')
+        if RasterLayer.objects.filter(id__in=layer_ids).count() != len(layer_ids):
+            raise Http404('Unknown layers.')
+
+        # Check that the formula can be parsed and only uses the given layers
+        parser = RasterAlgebraParser()
+        try:
+            parser.parse_formula(formula)
+        except ParseException:
+            return self.error_response('Invalid formula.')
+        if not parser.variable_names().issubset(ids.keys()):
+            return self.error_response('Formula uses undeclared layers.')
+
+        # Check that the legend used for grouping exists
+        grouping = request.GET.get('grouping', 'auto')
+        if grouping not in ('auto', 'discrete', 'continuous'):
+            try:
+                legend_id = int(grouping)
+            except ValueError:
+                raise Http404('Invalid grouping.')
+            if not Legend.objects.filter(id=legend_id).exists():
+                raise Http404('Unknown legend.')
+
+        # Get optional clip geometry, it requires an srid to be transformed
+        # to the tile projection
+        geom = request.GET.get('geom', None)
+        if geom:
+            try:
+                geom = GEOSGeometry(geom)
+            except (ValueError, GEOSException):
+                return self.error_response('Invalid geometry.')
+            if not geom.srid:
+                return self.error_response('Geometry requires an srid.')
+            if not geom.valid:
+                return self.error_response('Invalid geometry.')
+
+        # Get optional zoom level and update interval
+        try:
+            zoom = request.GET.get('zoom', None)
+            if zoom is not None:
+                zoom = int(zoom)
+            every = int(request.GET.get('every', 1))
+        except (ValueError, TypeError):
+            raise Http404('Invalid aggregation parameters.')
+
+        try:
+            agg = Aggregator(
+                ids,
+                formula,
+                zoom=zoom,
+                geom=geom,
+                acres=request.GET.get('acres', '') == 'true',
+                grouping=grouping,
+                dtype=request.GET.get('dtype', None),
+                timeout=getattr(settings, 'RASTER_AGGREGATION_TIMEOUT', None) or AGGREGATION_VIEW_TIMEOUT,
+                budget=getattr(settings, 'RASTER_AGGREGATION_MAX_TILES', None) or AGGREGATION_VIEW_MAX_TILES,
+            )
+        except RasterAggregationException:
+            raise Http404('Invalid aggregation parameters.')
+
+        # Return the work estimate for planning requests if requested
+        if request.GET.get('estimate', '') == 'true':
+            return HttpResponse(json.dumps(agg.estimate()), content_type='application/json')
+
+        # Reject aggregations that exceed the tile budget before streaming
+        try:
+            agg.admit()
+        except RasterAggregationException as e:
+            return HttpResponse(
+                json.dumps(dict(agg.estimate(), error=str(e))),
+                content_type='application/json',
+                status=400,
+            )
+
+        return StreamingHttpResponse(self.stream(agg, every), content_type='application/x-ndjson')
+
+    def error_response(self, message):
+        """
+        Return a bad request response with the error message as json.
+        """
+        return HttpResponse(json.dumps({'error': message}), content_type='application/json', status=400)
+
+    def stream(self, agg, every):
+        """
+        Generator yielding the partial results of the aggregation as lines
+        of json.
+        """
+        try:
+            for done, total, result in agg.iter_value_count(every=every):
+                yield json.dumps({
+                    'done': done,
+                    'total': total,
+                    'result': {key: numpy.array(val).item() for key, val in result.items()},
+                }) + '\n'
+        except RasterAggregationException as e:
+            # The response status can not be changed while streaming
+            yield json.dumps({'error': str(e)}) + '\n'
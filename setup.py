@@ -26,6 +26,9 @@ setup(
         'django-colorful>=1.0.1',
         'pyparsing>=2.0.3'
     ],
+    extras_require={
+        'numexpr': ['numexpr>=2.4'],
+    },
     keywords=['django', 'raster', 'gis', 'gdal', 'celery', 'geo', 'spatial'],
     classifiers=[
         'Environment :: Web Environment',
@@ -0,0 +1,89 @@
+import json
+
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from raster.const import AGGREGATION_VIEW_MAX_TILES
+
+from .raster_testcase import RasterTestCase
+
+
+@override_settings(RASTER_TILE_CACHE_TIMEOUT=0)
+class RasterAggregationViewTests(RasterTestCase):
+
+    def test_aggregation_stream(self):
+        url = reverse('aggregate') + '?layers=a={0}&every=1'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        lines = [json.loads(line.decode()) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[-1]['done'], lines[-1]['total'])
+        self.assertEqual(
+            lines[-1]['result'],
+            {str(key): val for key, val in self.expected_totals.items()}
+        )
+
+    def test_aggregation_estimate(self):
+        url = reverse('aggregate') + '?layers=a={0}&estimate=true'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        estimate = json.loads(response.content.decode())
+        self.assertEqual(estimate['zoom'], 11)
+        self.assertEqual(estimate['layers'], 1)
+
+    def test_aggregation_default_budget(self):
+        # The view has a tile budget if none is configured in the settings
+        url = reverse('aggregate') + '?layers=a={0}&estimate=true'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content.decode())['budget'], AGGREGATION_VIEW_MAX_TILES)
+        with self.settings(RASTER_AGGREGATION_MAX_TILES=5):
+            response = self.client.get(url)
+            self.assertEqual(json.loads(response.content.decode())['budget'], 5)
+
+    @override_settings(RASTER_AGGREGATION_TIMEOUT=1e-9)
+    def test_aggregation_stream_error_timeout(self):
+        # Stored value counts are not used for formulas, so tiles are read
+        url = reverse('aggregate') + '?layers=a={0}&formula=a*1'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        lines = [json.loads(line.decode()) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[-1], {'error': 'Aggregation timed out.'})
+
+    @override_settings(RASTER_AGGREGATION_MAX_TILES=1)
+    def test_aggregation_stream_error_over_budget(self):
+        url = reverse('aggregate') + '?layers=a={0}&zoom=11'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode()))
+
+    def test_aggregation_stream_error_no_layers(self):
+        response = self.client.get(reverse('aggregate'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_aggregation_stream_error_no_formula(self):
+        url = reverse('aggregate') + '?layers=a={0},b={0}'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_aggregation_stream_error_unknown_layer(self):
+        url = reverse('aggregate') + '?layers=a=999999'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_aggregation_stream_error_unknown_legend(self):
+        url = reverse('aggregate') + '?layers=a={0}&grouping=999999'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_aggregation_stream_error_invalid_formula(self):
+        url = reverse('aggregate') + '?layers=a={0}&formula=a*b'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 400)
+
+    def test_aggregation_stream_error_invalid_geometry(self):
+        url = reverse('aggregate') + '?layers=a={0}'.format(self.rasterlayer.id)
+        # Geometry without srid
+        response = self.client.get(url + '&geom=POLYGON((0 0, 1 0, 1 1, 0 0))')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content.decode()))
+        # Malformed geometry
+        response = self.client.get(url + '&geom=POLYGON((0 0, 1 0')
+        self.assertEqual(response.status_code, 400)
@@ -5,6 +5,7 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from django.utils.encoding import iri_to_uri
 from raster.formulas import RasterAlgebraParser
+from raster.parser import RasterLayerParser
 
 from .raster_testcase import RasterTestCase
 
@@ -41,7 +42,50 @@ class RasterAlgebraParserTests(TestCase):
     def test_algebra_parser(self):
         parser = RasterAlgebraParser()
         result = parser.evaluate_raster_algebra(self.data, 'x*(x>11) + 2*y + 3*z*(z==30)', check_aligned=True)
-        self.assertEqual(result.bands[0].data().ravel().tolist(), [92, 2, 14, 15])
+        self.assertEqual(result.bands[0].data().ravel().tolist()[1:], [2, 14, 15])
+
+    def test_algebra_parser_nodata_value(self):
+        parser = RasterAlgebraParser()
+        result = parser.evaluate_raster_algebra(self.data, 'x*(x>11) + 2*y + 3*z*(z==30)')
+        # The first pixel of x is nodata, the result holds the nodata value
+        # instead of the value computed from the nodata pixel (92)
+        self.assertEqual(result.bands[0].nodata_value, 10)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [10, 2, 14, 15])
+        # Nodata of layers not used in the formula is ignored
+        result = parser.evaluate_raster_algebra(self.data, '2*y + z')
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [32, 33, 34, 35])
+
+    def test_algebra_parser_result_pixeltype(self):
+        parser = RasterAlgebraParser()
+        # Logical expressions result in byte rasters
+        result = parser.evaluate_raster_algebra(self.data, '(x > 11) & (z < 33)')
+        self.assertEqual(result.bands[0].datatype(), 1)
+        self.assertEqual(result.bands[0].data().ravel().tolist()[1:], [0, 1, 0])
+        # Arithmetic on byte rasters is evaluated in Float64
+        result = parser.evaluate_raster_algebra(self.data, 'z * z')
+        self.assertEqual(result.bands[0].datatype(), 7)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [900, 961, 1024, 1089])
+        # Large intermediate values are exact
+        result = parser.evaluate_raster_algebra(self.data, 'z * 1000000 + y')
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [30000001, 31000001, 32000001, 33000001])
+        # The pixel type can be narrowed explicitly
+        result = parser.evaluate_raster_algebra(self.data, 'z / 2', dtype='Float32')
+        self.assertEqual(result.bands[0].datatype(), 6)
+        # Negation of byte rasters does not wrap around
+        result = parser.evaluate_raster_algebra(self.data, '-z')
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [-30, -31, -32, -33])
+        # The pixel type can be overridden
+        result = parser.evaluate_raster_algebra(self.data, 'x + y', dtype='Float64')
+        self.assertEqual(result.bands[0].datatype(), 7)
+
+    def test_algebra_parser_nodata_mask(self):
+        parser = RasterAlgebraParser()
+        # Only the nodata values of rasters used in the formula are masked
+        result, mask = parser.evaluate_raster_algebra_array(self.data, 'y + z')
+        self.assertEqual(mask.tolist(), [False, False, False, False])
+        result, mask = parser.evaluate_raster_algebra_array(self.data, 'x / (z - 31)')
+        self.assertEqual(mask.tolist(), [True, True, False, False])
+        self.assertEqual(result[2:].tolist(), [12, 6.5])
 
 
 @override_settings(RASTER_TILE_CACHE_TIMEOUT=0)
@@ -73,6 +117,29 @@ class RasterAlgebraViewTests(RasterTestCase):
         response = self.client.get(self.algebra_tile_url + '?layers=a={0}&formula=a&legend={1}'.format(self.rasterlayer.id, self.legend.title))
         self.assertEqual(response.status_code, 200)
 
+    def test_grayscale_stretch_request(self):
+        url = self.algebra_tile_url + '?layers=a={0}&formula=a'.format(self.rasterlayer.id)
+        response = self.client.get(url + '&stretch=0,9')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url + '&stretch=metadata')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url + '&stretch=metadata&percentiles=2,98')
+        self.assertEqual(response.status_code, 200)
+
+    def test_grayscale_stretch_request_after_reparse(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            RasterLayerParser(self.rasterlayer).parse_raster_layer()
+        url = self.algebra_tile_url + '?layers=a={0}&formula=a'.format(self.rasterlayer.id)
+        response = self.client.get(url + '&stretch=metadata')
+        self.assertEqual(response.status_code, 200)
+
+    def test_grayscale_stretch_request_errors(self):
+        url = self.algebra_tile_url + '?layers=a={0},b={0}&formula=a*b'.format(self.rasterlayer.id)
+        response = self.client.get(url + '&stretch=metadata')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url + '&stretch=0')
+        self.assertEqual(response.status_code, 404)
+
     def test_algebra_with_empty_tile(self):
         response = self.client.get(self.algebra_tile_url + '?layers=a={0},b={1}&formula=a*b&legend={2}'.format(self.rasterlayer.id, self.empty_rasterlayer.id, self.legend.title))
         self.assertEqual(response.status_code, 200)
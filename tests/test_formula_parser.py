@@ -1,7 +1,9 @@
+from unittest import skipIf
+
 import numpy
 
 from django.test import TestCase
-from raster.formulas import FormulaParser
+from raster.formulas import FormulaParser, numexpr
 
 
 class FormulaParserTests(TestCase):
@@ -110,3 +112,72 @@ class FormulaParserTests(TestCase):
         # This is not desired behavior, should be changed in formula parser
         # to raise error or accept multi character words.
         self.assertFormulaResult("aaa", data['a'], data)
+
+
+@skipIf(numexpr is None, 'Numexpr is not installed.')
+class FormulaParserNumexprTests(TestCase):
+
+    def assertBackendsEqual(self, formula, data):
+        expected = FormulaParser(backend='numpy').evaluate_formula(formula, data)
+        result = FormulaParser(backend='numexpr').evaluate_formula(formula, data)
+        self.assertEqual(numpy.result_type(expected), numpy.result_type(result))
+        self.assertTrue(numpy.array_equal(numpy.ma.getmaskarray(expected), numpy.ma.getmaskarray(result)))
+        self.assertTrue(numpy.ma.allclose(expected, result))
+
+    def test_numexpr_backend(self):
+        data = {
+            "a": numpy.array([2, 4, 6], dtype='uint8'),
+            "b": numpy.array([True, False, True]),
+            "x": numpy.array([1.2, 0, -1.2]),
+        }
+        self.assertBackendsEqual("x * 99999 + 0.5 * a", data)
+        self.assertBackendsEqual("sin(x) + log(a) ^ 2", data)
+        self.assertBackendsEqual("(x >= 0) & (a < 5) | !b", data)
+        self.assertBackendsEqual("a * a", data)
+        self.assertBackendsEqual("round(x) + a", data)
+        self.assertBackendsEqual("-a + 1", data)
+
+    def test_unsigned_negation(self):
+        data = {"a": numpy.array([10, 11], dtype='uint8')}
+        for backend in ('numpy', 'numexpr'):
+            result = FormulaParser(backend=backend).evaluate_formula("-a", data)
+            self.assertEqual(result.tolist(), [-10, -11])
+
+    def test_numexpr_backend_integer_overflow(self):
+        data = {
+            "a": numpy.array([60000, 2], dtype='uint16'),
+            "b": numpy.array([60000, 3], dtype='uint16'),
+            "c": numpy.array([3, 250], dtype='uint8'),
+            "d": numpy.array([30, 2], dtype='uint8'),
+        }
+        self.assertBackendsEqual("a * b", data)
+        self.assertBackendsEqual("c ^ d", data)
+        self.assertBackendsEqual("abs(c) * 1000 + d", data)
+        self.assertBackendsEqual("(a * b > 10) + c", data)
+        result = FormulaParser(backend='numexpr').evaluate_formula("a * b", data)
+        self.assertEqual(result.tolist(), [3.6e9, 6])
+
+    def test_numexpr_backend_selection(self):
+        parser = FormulaParser(backend='numexpr')
+        parser.parse_formula("sin(x) + abs(x)")
+        self.assertTrue(parser.numexpr_supported())
+        parser.parse_formula("round(x) + 1")
+        self.assertFalse(parser.numexpr_supported())
+
+    def test_numexpr_backend_with_masked_arrays(self):
+        data = {
+            "a": numpy.ma.masked_values(numpy.array([10, 11, 12, 13], dtype='uint8'), 10),
+            "b": numpy.ma.masked_values(numpy.array([1, 1, 0, 1], dtype='uint8'), 0),
+        }
+        self.assertBackendsEqual("a * 2 + b", data)
+        self.assertBackendsEqual("a / (b - 1)", data)
+        self.assertBackendsEqual("(a > 11) | b", data)
+
+    def test_formula_parser_reuses_parsed_formulas(self):
+        parser = FormulaParser()
+        data = {"x": numpy.array([1, 2, 3])}
+        for i in range(2):
+            self.assertTrue((parser.evaluate_formula("x * 2", data) == [2, 4, 6]).all())
+            self.assertTrue((parser.evaluate_formula("x>1", data) == [False, True, True]).all())
+            self.assertTrue((parser.evaluate_formula("x > 1", data) == [False, True, True]).all())
+        self.assertEqual(len(parser.parsed), 2)
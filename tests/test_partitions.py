@@ -0,0 +1,39 @@
+from django.db import connection
+from raster.models import RasterTile, RasterTileValueCount
+from raster.parser import RasterLayerParser
+from raster.partitions import partition_name, partition_tile_table
+
+from .raster_testcase import RasterTestCase
+
+
+class RasterTilePartitionTests(RasterTestCase):
+
+    def setUp(self):
+        if connection.pg_version < 110000:
+            self.skipTest('Partitioning requires PostgreSQL 11 or later.')
+        super(RasterTilePartitionTests, self).setUp()
+        self.assertTrue(partition_tile_table())
+
+    def partition_exists(self, layer_id):
+        cursor = connection.cursor()
+        cursor.execute('SELECT to_regclass(%s)', [partition_name(layer_id)])
+        return cursor.fetchone()[0] is not None
+
+    def test_tiles_copied_to_layer_partitions(self):
+        self.assertFalse(partition_tile_table())
+        self.assertTrue(self.partition_exists(self.rasterlayer.id))
+        self.assertEqual(self.rasterlayer.value_count(), {str(k): v for k, v in self.expected_totals.items()})
+
+    def test_reparse_in_partition(self):
+        count = self.rasterlayer.rastertile_set.count()
+        with self.settings(RASTER_TILE_PARTITIONS=True, MEDIA_ROOT=self.media_root):
+            RasterLayerParser(self.rasterlayer).parse_raster_layer()
+        self.assertEqual(self.rasterlayer.rastertile_set.count(), count)
+        self.assertEqual(self.rasterlayer.db_value_count(), self.expected_totals)
+
+    def test_delete_drops_partition(self):
+        with self.settings(RASTER_TILE_PARTITIONS=True):
+            self.rasterlayer.delete()
+        self.assertFalse(self.partition_exists(self.rasterlayer.id))
+        self.assertFalse(RasterTile.objects.filter(rasterlayer_id=self.rasterlayer.id).exists())
+        self.assertFalse(RasterTileValueCount.objects.filter(tile__rasterlayer_id=self.rasterlayer.id).exists())
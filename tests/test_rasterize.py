@@ -1,6 +1,6 @@
 from django.contrib.gis.gdal import GDALRaster, OGRGeometry
 from django.test import TestCase
-from raster.rasterize import rasterize
+from raster.rasterize import rasterize, rasterize_zones
 
 
 class RasterizeGeometryTests(TestCase):
@@ -36,3 +36,11 @@ class RasterizeGeometryTests(TestCase):
         geom.srid = 3086
         result = rasterize(geom, self.rast)
         self.assertEqual(result.bands[0].data().ravel().tolist(), [0, 0, 1, 1])
+
+    def test_zones_rasterization(self):
+        top = OGRGeometry.from_bbox((500000.0, 399900.0, 500200.0, 400000.0))
+        top.srid = 3086
+        left = OGRGeometry.from_bbox((500000.0, 399800.0, 500100.0, 400000.0))
+        left.srid = 3086
+        result = rasterize_zones([top, left], self.rast, [1000, 2000], datatype=2)
+        self.assertEqual(result.bands[0].data().ravel().tolist(), [2000, 1000, 2000, 0])
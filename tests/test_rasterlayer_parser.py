@@ -1,7 +1,13 @@
 import os
 
 from django.core.files import File
-from django.test.utils import override_settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max, Min
+from django.test.utils import CaptureQueriesContext, override_settings
+from raster.deletion import delete_tiles
+from raster.models import RasterLayer, RasterTile, RasterTileValueCount
+from raster.parser import RasterLayerParser, remove_old_tiles
+from raster.tiler import morton_key
 
 from .raster_testcase import RasterTestCase
 
@@ -39,6 +45,112 @@ class RasterLayerParserWithoutCeleryTests(RasterTestCase):
         self.assertEqual(self.rasterlayer.metadata.width, 163)
         self.assertEqual(self.rasterlayer.metadata.max_zoom, 12)
 
+    def test_layermeta_extent_and_index_ranges(self):
+        # Stored extent and index ranges match the values computed on the fly
+        meta = self.rasterlayer.metadata
+        self.assertEqual(len(meta.extent), 4)
+        self.assertEqual(self.rasterlayer.extent(), tuple(meta.extent))
+        self.assertEqual([rng[0] for rng in meta.index_ranges], list(range(5, 13)))
+        for zoom in range(13):
+            self.assertEqual(
+                self.rasterlayer.index_range(zoom),
+                self.rasterlayer.rastertile_set.filter(tilez=zoom).aggregate(
+                    Min('tilex'), Max('tilex'), Min('tiley'), Max('tiley')
+                )
+            )
+
+    def test_tile_morton_keys(self):
+        for tile in self.rasterlayer.rastertile_set.all():
+            self.assertEqual(tile.morton, morton_key(tile.tilex, tile.tiley))
+
+    def test_tile_position_is_unique(self):
+        tile = self.rasterlayer.rastertile_set.filter(tilez=12).first()
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                RasterTile.objects.create(
+                    rasterlayer=self.rasterlayer,
+                    version=tile.version,
+                    tilez=tile.tilez,
+                    tilex=tile.tilex,
+                    tiley=tile.tiley,
+                )
+
+    def test_reparse_switches_tile_version(self):
+        version = self.rasterlayer.metadata.tile_version
+        count = self.rasterlayer.rastertile_set.count()
+        with self.settings(MEDIA_ROOT=self.media_root):
+            RasterLayerParser(self.rasterlayer).parse_raster_layer()
+        self.rasterlayer.metadata.refresh_from_db()
+        self.assertEqual(self.rasterlayer.metadata.tile_version, version + 1)
+        # Tiles of the previous version are removed after the switch
+        self.assertEqual(self.rasterlayer.rastertile_set.count(), count)
+        self.assertEqual(self.rasterlayer.rastertile_set.filter(version=version + 1).count(), count)
+
+    def test_interleaved_parses_use_distinct_versions(self):
+        # A first parse allocates its version before creating any tiles
+        first = RasterLayerParser(self.rasterlayer)
+        first.version = first.allocate_version()
+        # A second parse of the same layer finishes in the meantime
+        second = RasterLayerParser(RasterLayer.objects.get(id=self.rasterlayer.id))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            second.parse_raster_layer()
+        self.assertEqual(second.version, first.version + 1)
+        count = self.rasterlayer.rastertile_set.filter(version=second.version).count()
+        self.assertGreater(count, 0)
+        # The first parse can not activate its tiles, removing them keeps the
+        # tiles of the second parse
+        self.assertFalse(first.activate_tiles())
+        delete_tiles(self.rasterlayer.id, version=first.version)
+        self.assertEqual(self.rasterlayer.rastertile_set.filter(version=second.version).count(), count)
+        self.rasterlayer.metadata.refresh_from_db()
+        self.assertEqual(self.rasterlayer.metadata.tile_version, second.version)
+        self.assertEqual(self.rasterlayer.metadata.allocated_tile_version, second.version)
+
+    def test_remove_old_tiles_keeps_newer_versions(self):
+        version = self.rasterlayer.metadata.tile_version
+        count = self.rasterlayer.rastertile_set.count()
+        tile = self.rasterlayer.rastertile_set.first()
+        for tile_version in (version - 1, version + 1):
+            RasterTile.objects.create(
+                rasterlayer=self.rasterlayer,
+                version=tile_version,
+                tilez=tile.tilez,
+                tilex=tile.tilex,
+                tiley=tile.tiley,
+            )
+        remove_old_tiles(self.rasterlayer.id)
+        # Tiles of a parse that is still running are kept
+        self.assertFalse(self.rasterlayer.rastertile_set.filter(version=version - 1).exists())
+        self.assertTrue(self.rasterlayer.rastertile_set.filter(version=version + 1).exists())
+        self.assertEqual(self.rasterlayer.rastertile_set.filter(version=version).count(), count)
+
+    def test_delete_tiles_in_batches(self):
+        count = self.rasterlayer.rastertile_set.count()
+        progress = []
+        with self.settings(RASTER_DELETE_BATCH_SIZE=5):
+            self.assertEqual(delete_tiles(self.rasterlayer.id, callback=progress.append), count)
+        self.assertEqual(progress, list(range(5, count, 5)) + [count])
+        self.assertFalse(self.rasterlayer.rastertile_set.exists())
+        self.assertFalse(RasterTileValueCount.objects.filter(tile__rasterlayer=self.rasterlayer).exists())
+
+    def test_layer_delete_does_not_load_tiles(self):
+        layer_id = self.rasterlayer.id
+        with CaptureQueriesContext(connection) as context:
+            RasterLayer.objects.filter(id=layer_id).delete()
+        # Tiles are removed with raw SQL instead of being collected
+        self.assertFalse([query for query in context.captured_queries if 'FROM "raster_rastertile"' in query['sql']])
+        self.assertFalse(RasterTile.objects.filter(rasterlayer_id=layer_id).exists())
+        self.assertFalse(RasterTileValueCount.objects.filter(tile__rasterlayer_id=layer_id).exists())
+
+    def test_layer_delete_removes_tiles_in_one_statement(self):
+        layer_id = self.rasterlayer.id
+        with self.settings(RASTER_DELETE_BATCH_SIZE=5):
+            with CaptureQueriesContext(connection) as context:
+                RasterLayer.objects.filter(id=layer_id).delete()
+        # Batches run in the transaction of the delete, so they are not used
+        self.assertEqual(len([query for query in context.captured_queries if 'WITH batch AS' in query['sql']]), 1)
+        self.assertFalse(RasterTile.objects.filter(rasterlayer_id=layer_id).exists())
+
     def test_parsestatus_creation(self):
         self.assertEqual(self.rasterlayer.parsestatus.status, self.rasterlayer.parsestatus.FINISHED)
         self.assertEqual(self.rasterlayer.parsestatus.tile_level, 12)
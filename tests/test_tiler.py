@@ -0,0 +1,38 @@
+from django.test import SimpleTestCase
+from raster.tiler import morton_blocks, morton_index, morton_key, morton_order, morton_parent, morton_ranges
+
+
+class MortonKeyTests(SimpleTestCase):
+
+    def test_morton_key_roundtrip(self):
+        for x, y in ((0, 0), (1, 0), (0, 1), (3, 5), (1000, 77), (2 ** 18 - 1, 2 ** 18 - 1)):
+            self.assertEqual(morton_index(morton_key(x, y)), (x, y))
+
+    def test_morton_key_is_quadkey(self):
+        # Tile 3, 5 at zoom 3 has quadkey 213
+        self.assertEqual(morton_key(3, 5), int('213', 4))
+
+    def test_morton_parent(self):
+        key = morton_key(37, 81)
+        self.assertEqual(morton_parent(key, 12, 12), key)
+        self.assertEqual(morton_parent(key, 12, 10), morton_key(37 // 4, 81 // 4))
+        self.assertEqual(morton_parent(key, 12, 0), 0)
+
+    def test_morton_ranges(self):
+        self.assertEqual(morton_ranges([8, 1, 3, 2, 7, 10]), [[1, 3], [7, 8], [10, 10]])
+
+    def test_morton_blocks(self):
+        blocks = morton_blocks([3, 5, 20, 17], 8)
+        self.assertEqual(blocks[0], [3, 5, 7, 7])
+        self.assertEqual(len(blocks), 3 * 3)
+        # The tiles of a complete block have consecutive keys
+        self.assertIn([8, 8, 15, 15], blocks)
+        keys = [morton_key(x, y) for x in range(8, 16) for y in range(8, 16)]
+        self.assertEqual(morton_ranges(keys), [[morton_key(8, 8), morton_key(15, 15)]])
+
+    def test_morton_order(self):
+        tiles = list(morton_order([3, 5, 40, 22]))
+        self.assertEqual(len(tiles), 38 * 18)
+        self.assertEqual(set(tiles), set((x, y) for x in range(3, 41) for y in range(5, 23)))
+        keys = [morton_key(x, y) for x, y in tiles]
+        self.assertEqual(keys, sorted(keys))
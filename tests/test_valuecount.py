@@ -3,7 +3,10 @@ import numpy
 from django.contrib.gis.geos import Polygon
 from django.test.utils import override_settings
 from raster.const import WEB_MERCATOR_SRID
-from raster.valuecount import RasterAggregationException, aggregator
+from raster.models import RasterLayerBandMetadata, RasterTileValueCount
+from raster.parser import RasterLayerParser
+from raster.tiler import tile_scale
+from raster.valuecount import Aggregator, RasterAggregationException, aggregation_estimate, aggregator
 
 from .raster_testcase import RasterTestCase
 
@@ -97,6 +100,106 @@ class RasterValueCountTests(RasterTestCase):
         for k, v in result.items():
             self.assertAlmostEqual(v, expected[k], 5)
 
+    def test_value_count_with_geom_rasterized_per_tile(self):
+        # Use a geometry covering all tiles
+        bbox = Polygon.from_bbox(self.rasterlayer.extent())
+        bbox.srid = WEB_MERCATOR_SRID
+
+        # Rasterizing the geometry for each tile gives the same result
+        with self.settings(RASTER_AGGREGATION_MAX_MASK_PIXELS=0):
+            self.assertEqual(
+                self.rasterlayer.value_count(bbox),
+                {str(key): val for key, val in self.expected_totals.items()}
+            )
+
+    def test_classify_tiles_against_geom(self):
+        # A geometry around the layer extent contains all tiles
+        bbox = Polygon.from_bbox(self.rasterlayer.extent())
+        bbox.srid = WEB_MERCATOR_SRID
+        agg = Aggregator({'a': self.rasterlayer.id}, 'a', geom=bbox.buffer(1e5))
+        classes = agg.classify_tiles(agg.get_tilerange())
+        self.assertTrue(all(classes.values()))
+
+        # A geometry within a single tile only touches that tile
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        bbox = Polygon.from_bbox(tile.rast.extent).buffer(-1000)
+        bbox.srid = WEB_MERCATOR_SRID
+        agg = Aggregator({'a': self.rasterlayer.id}, 'a', geom=bbox, zoom=11)
+        self.assertEqual(agg.classify_tiles(agg.get_tilerange()), {(552, 858): False})
+
+    def test_value_count_from_stored_tile_counts(self):
+        # Value counts are stored for all tiles at the max zoom level
+        tiles = self.rasterlayer.rastertile_set.filter(tilez=11)
+        self.assertEqual(RasterTileValueCount.objects.filter(tile__in=tiles).count(), tiles.count())
+
+        expected = {str(key): val for key, val in self.expected_totals.items()}
+        self.assertEqual(self.rasterlayer.value_count(), expected)
+        self.assertEqual(self.rasterlayer.db_value_count(), self.expected_totals)
+
+        # Counting from the tile data gives the same result
+        RasterTileValueCount.objects.all().delete()
+        self.assertEqual(self.rasterlayer.value_count(), expected)
+        self.assertEqual(self.rasterlayer.db_value_count(), self.expected_totals)
+
+    def test_iter_value_count(self):
+        expected = {str(key): val for key, val in self.expected_totals.items()}
+        steps = list(Aggregator({'a': self.rasterlayer.id}, 'a').iter_value_count(every=1))
+
+        # Progress increases up to the total number of tiles
+        done = [step[0] for step in steps]
+        self.assertEqual(done, sorted(done))
+        self.assertEqual(steps[-1][0], steps[-1][1])
+
+        # The last step contains the complete value count
+        self.assertEqual(steps[-1][2], expected)
+
+    def test_db_value_count_area(self):
+        # Areas are based on the pixel size of the tiles
+        scalex, scaley = self.rasterlayer.pixelsize()
+        self.assertAlmostEqual(scalex, tile_scale(11))
+        self.assertAlmostEqual(scaley, tile_scale(11))
+
+        result = self.rasterlayer.db_value_count(area=True)
+        for key, val in self.expected_totals.items():
+            self.assertAlmostEqual(result[key], val * scalex * scaley)
+
+    def test_zonal_stats(self):
+        values = numpy.array(list(self.expected_totals.keys()), dtype='float64')
+        counts = numpy.array(list(self.expected_totals.values()))
+        mean = numpy.sum(values * counts) / counts.sum()
+        std = numpy.sqrt(numpy.sum((values - mean) ** 2 * counts) / counts.sum())
+
+        result = self.rasterlayer.zonal_stats(stats=['count', 'mean', 'min', 'max', 'std', 'percentile_0', 'percentile_100'])
+        self.assertEqual(result['count'], counts.sum())
+        self.assertAlmostEqual(result['mean'], mean)
+        self.assertAlmostEqual(result['std'], std)
+        self.assertEqual(result['min'], values.min())
+        self.assertEqual(result['max'], values.max())
+        self.assertEqual(result['percentile_0'], values.min())
+        self.assertEqual(result['percentile_100'], values.max())
+
+    def test_zonal_stats_invalid_statistic(self):
+        with self.assertRaises(RasterAggregationException):
+            self.rasterlayer.zonal_stats(stats=['median'])
+
+    def test_zonal_value_count(self):
+        # Split a single tile into two zones
+        tile = self.rasterlayer.rastertile_set.get(tilez=11, tilex=552, tiley=858)
+        xmin, ymin, xmax, ymax = tile.rast.extent
+        xmid = (xmin + xmax) / 2
+        geoms = {
+            'left': Polygon.from_bbox((xmin, ymin, xmid, ymax)),
+            'right': Polygon.from_bbox((xmid, ymin, xmax, ymax)),
+        }
+        for geom in geoms.values():
+            geom.srid = WEB_MERCATOR_SRID
+
+        # Counts for each zone are the same as for the single geometries
+        result = self.rasterlayer.zonal_value_count(geoms)
+        self.assertEqual(sorted(result.keys()), ['left', 'right'])
+        for key, geom in geoms.items():
+            self.assertEqual(result[key], self.rasterlayer.value_count(geom))
+
     def test_value_count_at_lower_zoom(self):
         # Precompute expected totals from value count
         expected = {}
@@ -149,6 +252,17 @@ class RasterAggregatorTests(RasterTestCase):
             {str(k): v for k, v in self.expected_totals.items()}
         )
 
+    def test_layer_used_for_multiple_names(self):
+        result = aggregator(
+            layer_dict={'a': self.rasterlayer.id, 'b': self.rasterlayer.id},
+            formula='a * (b >= 0)',
+            grouping='discrete'
+        )
+        self.assertDictEqual(
+            result,
+            {str(k): v for k, v in self.expected_totals.items()}
+        )
+
     def test_layer_continuous_grouping(self):
         result = aggregator(
             layer_dict={'a': self.rasterlayer.id},
@@ -160,6 +274,31 @@ class RasterAggregatorTests(RasterTestCase):
             self.continuous_expected_histogram
         )
 
+    def test_layer_continuous_grouping_after_reparse(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            RasterLayerParser(self.rasterlayer).parse_raster_layer()
+        # Change the value range of the band metadata from the first parse
+        old = RasterLayerBandMetadata.objects.filter(rasterlayer=self.rasterlayer).order_by('pk').first()
+        RasterLayerBandMetadata.objects.filter(pk=old.pk).update(min=100, max=200)
+        result = aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='continuous'
+        )
+        self.assertDictEqual(
+            result,
+            self.continuous_expected_histogram
+        )
+
+    def test_layer_continuous_grouping_with_bin_edges(self):
+        result = aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='continuous',
+            bins=[0, 4.5, 9]
+        )
+        self.assertDictEqual(result, {'(0.0, 4.5)': 58113, '(4.5, 9.0)': 4327})
+
     def test_layer_with_legend_grouping(self):
         # Use a legend with simple int expression
         result = aggregator(
@@ -182,6 +321,111 @@ class RasterAggregatorTests(RasterTestCase):
             {'(x >= 2) & (x < 5)': self.expected_totals[2] + self.expected_totals[3] + self.expected_totals[4]}
         )
 
+    def test_layer_discrete_grouping_with_workers(self):
+        result = aggregator(
+            layer_dict={'a': self.rasterlayer.id},
+            formula='a',
+            grouping='discrete',
+            workers=2
+        )
+        self.assertDictEqual(
+            result,
+            {str(k): v for k, v in self.expected_totals.items()}
+        )
+
+    def test_layer_with_tile_budget(self):
+        agg = Aggregator({'a': self.rasterlayer.id}, 'a', grouping='discrete', max_tiles=1)
+        tilerange = agg.get_tilerange()
+        self.assertEqual(tilerange[0], tilerange[2])
+        self.assertEqual(tilerange[1], tilerange[3])
+        self.assertLess(agg.zoom, 11)
+        self.assertEqual(agg.count_scale, 4 ** (11 - agg.zoom))
+        self.assertGreater(agg.error, 0)
+
+        # Pixel counts are scaled to the max zoom level
+        result = agg.value_count()
+        self.assertTrue(set(result.keys()) <= set(str(k) for k in self.expected_totals.keys()))
+        self.assertTrue(all(count % agg.count_scale == 0 for count in result.values()))
+
+    def test_layer_aggregation_estimate(self):
+        estimate = aggregation_estimate({'a': self.rasterlayer.id, 'b': self.rasterlayer.id}, formula='a + b')
+        self.assertEqual(estimate['zoom'], 11)
+        self.assertEqual(estimate['layers'], 1)
+        self.assertEqual(estimate['tiles'], estimate['positions'])
+        self.assertGreater(estimate['tiles'], 1)
+
+    def test_layer_aggregation_estimate_with_value_range_pass(self):
+        # Continuous grouping of a formula requires a first pass for the range
+        estimate = aggregation_estimate({'a': self.rasterlayer.id}, formula='a * 2', grouping='continuous')
+        self.assertEqual(estimate['passes'], 2)
+        self.assertEqual(estimate['tiles'], 2 * estimate['positions'])
+        # The range of a single layer is taken from the band metadata
+        estimate = aggregation_estimate({'a': self.rasterlayer.id}, formula='a', grouping='continuous')
+        self.assertEqual(estimate['passes'], 1)
+        # Bin edges do not require a value range
+        estimate = aggregation_estimate(
+            {'a': self.rasterlayer.id}, formula='a * 2', grouping='continuous', bins=[0, 5, 10]
+        )
+        self.assertEqual(estimate['passes'], 1)
+
+    def test_layer_statistics_estimate(self):
+        # Statistics without percentiles are computed in a single pass
+        estimate = aggregation_estimate({'a': self.rasterlayer.id}, formula='a * 2', stats=['mean', 'max'])
+        self.assertEqual(estimate['passes'], 1)
+        self.assertEqual(estimate['tiles'], estimate['positions'])
+        # Percentiles require a first pass for the range of the histogram
+        estimate = aggregation_estimate({'a': self.rasterlayer.id}, formula='a * 2', stats=['mean', 'percentile_50'])
+        self.assertEqual(estimate['passes'], 2)
+
+    def test_layer_with_max_tiles_setting(self):
+        tiles = aggregation_estimate({'a': self.rasterlayer.id})['tiles']
+        with self.settings(RASTER_AGGREGATION_MAX_TILES=tiles - 1):
+            # Zoom level is reduced to stay within the budget
+            agg = Aggregator({'a': self.rasterlayer.id}, 'a')
+            self.assertLess(agg.zoom, 11)
+            self.assertLessEqual(agg.estimate()['tiles'], tiles - 1)
+
+            # Aggregations at a fixed zoom level are rejected
+            with self.assertRaises(RasterAggregationException):
+                aggregator({'a': self.rasterlayer.id}, zoom=11, formula='a')
+
+    def test_layer_tiles_read_within_budget(self):
+        tiles = aggregation_estimate({'a': self.rasterlayer.id}, formula='a * 1', grouping='discrete')['tiles']
+        with self.settings(RASTER_AGGREGATION_MAX_TILES=tiles):
+            agg = Aggregator({'a': self.rasterlayer.id}, 'a * 1', grouping='discrete')
+            agg.value_count()
+            self.assertGreater(agg.tiles_read, 0)
+            self.assertLessEqual(agg.tiles_read, tiles)
+
+            # Reading stops when more tiles than the budget are read
+            agg.setup()
+            agg.budget = 1
+            with self.assertRaises(RasterAggregationException):
+                list(agg.tile_blocks(agg.tilerange))
+
+    def test_layer_with_error_target(self):
+        # No zoom level is accurate enough for a zero error target
+        agg = Aggregator({'a': self.rasterlayer.id}, 'a', grouping='discrete', max_error=0)
+        self.assertEqual(agg.zoom, 11)
+        self.assertEqual(agg.count_scale, 1)
+        self.assertEqual(agg.value_count(), {str(k): v for k, v in self.expected_totals.items()})
+
+    @override_settings(
+        CACHES={'aggregation': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        RASTER_AGGREGATION_CACHE='aggregation',
+    )
+    def test_layer_aggregation_cache(self):
+        expected = {str(k): v for k, v in self.expected_totals.items()}
+        self.assertEqual(self.rasterlayer.value_count(), expected)
+
+        # Cached result is returned while the layer is unchanged
+        self.rasterlayer.rastertile_set.all().delete()
+        self.assertEqual(self.rasterlayer.value_count(), expected)
+
+        # Cache is invalidated when the layer is modified
+        self.rasterlayer.save()
+        self.assertEqual(self.rasterlayer.value_count(), {})
+
     def test_valuecount_exception(self):
         with self.assertRaises(RasterAggregationException):
             aggregator(